@@ -0,0 +1,286 @@
+"""
+In-process stand-ins for the EspoCRM and RedRose APIs used by the pipeline, with synthetic data,
+configurable latency and error rate
+"""
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qsl
+
+ACTIVITIES = ['activity-1', 'activity-2']
+OBLASTS = ['Lviv', 'Kyiv', 'Odesa', 'Kharkiv', 'Dnipro', 'Zaporizhzhia', 'Vinnytsia', 'Poltava']
+BANKS = ['PrivatBank', 'Oschadbank', 'Monobank', 'Raiffeisen Bank', 'Ukrsibbank']
+FIRST_NAMES = ['Олена', 'Андрій', 'Оксана', 'Тарас', 'Ірина', 'Mykola', 'Yulia', 'Petro']
+LAST_NAMES = ['Шевченко', 'Коваленко', 'Бондаренко', 'Tkachenko', 'Kravchenko', 'Melnyk']
+
+
+def make_dataset(n_beneficiaries, n_payments=None, n_transactions=None, seed=0):
+    """Synthetic Shelter, Payment (with streams) and RedRose transaction records"""
+    rng = random.Random(seed)
+    n_payments = n_beneficiaries if n_payments is None else n_payments
+    n_transactions = n_payments if n_transactions is None else n_transactions
+    today = date.today()
+    now = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+
+    shelters = {}
+    for i in range(n_beneficiaries):
+        id_ = f'{i:017x}'
+        iban = f'UA{rng.randrange(10 ** 27):027d}'
+        shelters[id_] = {
+            'id': id_, 'shelterID': f'SH{i:07d}', 'rrName': rng.choice(FIRST_NAMES),
+            'rrSurname': rng.choice(LAST_NAMES), 'contactName': f'Contact {i}', 'status': 'Approved',
+            'accType': 'Apartment', 'modifiedByName': 'Admin',
+            'iban': iban, 'ibanpayment': iban, 'paymentBankName': rng.choice(BANKS),
+            'bicPayment': f'BIC{rng.randrange(10 ** 5):05d}', 'gh0': 'Ukraine', 'gh1': rng.choice(OBLASTS),
+            'rrNotes': None, 'reasonIbanChange': None, 'modifiedAt': now,
+            # half of the beneficiaries are already in RedRose
+            'redroseInternalID': str(uuid.UUID(int=rng.getrandbits(128))) if i % 2 else None,
+        }
+    shelter_ids = list(shelters)
+
+    payments, transactions = {}, []
+    for i in range(n_payments):
+        id_ = f'{i:017x}'
+        shelter = shelters[shelter_ids[i % len(shelter_ids)]]
+        # a third of the payments are ready to be paid, the others were topped up in the last days
+        ready = i % 3 == 0
+        date_ = today - timedelta(days=rng.randrange(0, 5))
+        payments[id_] = {
+            'id': id_, 'internalId': shelter['shelterID'], 'shelterID': shelter['shelterID'],
+            'shelterId': shelter['id'], 'shelterName': shelter['contactName'], 'amount': 3000.,
+            'amountCurrency': 'UAH', 'numPayment': 1, 'numberOfPayments': 3, 'modifiedAt': now,
+            'rrActivity': rng.choice(ACTIVITIES), 'status': 'readyforpayment' if ready else 'Pending',
+            'date': date_.strftime("%Y-%m-%d"), 'dateTopup': None if ready else date_.strftime("%Y-%m-%d"),
+            'transactionID': None,
+        }
+        if not ready and len(transactions) < n_transactions:
+            transactions.append({
+                'id': f'{i:017x}', 'iqId': shelter['shelterID'],
+                'dated': (date_ + timedelta(days=rng.randrange(1, 4))).strftime("%Y-%m-%dT%H:%M:%S"),
+                'salesStatus': rng.choice(['Approved', 'Approved', 'Approved', 'Cancelled']), 'amount': 3000.,
+            })
+    # older transactions, which do not match any open payment
+    while len(transactions) < n_transactions:
+        shelter = shelters[rng.choice(shelter_ids)]
+        transactions.append({
+            'id': f'{n_payments + len(transactions):017x}', 'iqId': shelter['shelterID'],
+            'dated': (today - timedelta(days=rng.randrange(30, 365))).strftime("%Y-%m-%dT%H:%M:%S"),
+            'salesStatus': 'Approved', 'amount': 3000.,
+        })
+
+    streams = {
+        id_: [{'id': f's{id_}', 'type': 'Update', 'parentId': id_, 'createdAt': now, 'createdByName': 'Admin',
+               'data': {'fields': ['ibanpayment']}}] if int(id_, 16) % 10 == 0 else []
+        for id_ in shelter_ids
+    }
+    return {'Shelter': shelters, 'Payment': payments}, streams, transactions
+
+
+def parse_query(query):
+    """Parse a query string built by http_build_query back into nested dicts and lists"""
+    data = {}
+    for key, value in parse_qsl(query, keep_blank_values=True):
+        parts = re.findall(r'[^\[\]]+', key)
+        node = data
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = value
+
+    def to_lists(node):
+        if not isinstance(node, dict):
+            return node
+        if node and all(k.isdigit() for k in node):
+            return [to_lists(node[k]) for k in sorted(node, key=int)]
+        return {k: to_lists(v) for k, v in node.items()}
+    return to_lists(data)
+
+
+def matches(record, condition):
+    """Evaluate an EspoCRM where condition (the types used by the pipeline) on a record"""
+    type_ = condition['type']
+    if type_ == 'and':
+        return all(matches(record, c) for c in condition['value'])
+    if type_ == 'or':
+        return any(matches(record, c) for c in condition['value'])
+    value = record.get(condition.get('attribute'))
+    if type_ == 'equals':
+        return value is not None and str(value) == condition['value']
+    if type_ == 'in':
+        values = condition['value'] if isinstance(condition['value'], list) else [condition['value']]
+        return value is not None and str(value) in values
+    if type_ == 'isNull':
+        return value is None
+    if type_ == 'after':
+        return value is not None and value > condition['value']
+    if type_ == 'today':
+        return value is not None and value[:10] == date.today().strftime("%Y-%m-%d")
+    if type_ == 'past':
+        return value is not None and value[:10] < date.today().strftime("%Y-%m-%d")
+    raise ValueError(f'unsupported where type {type_}')
+
+
+class FakeAPIHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+    # headers and body are written separately: without TCP_NODELAY each response waits for a delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_request(self, method):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) if length else b''
+        api = self.server.api
+        api.count_request()
+        if api.latency:
+            time.sleep(api.latency)
+        if api.error_rate and random.random() < api.error_rate:
+            self.send_json({'error': 'simulated error'}, 503)
+            return
+        url = urlparse(self.path)
+        try:
+            result = api.handle(method, url.path, parse_query(url.query), body)
+        except KeyError:
+            self.send_json({'error': 'not found'}, 404)
+            return
+        self.send_json(result)
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+
+class FakeAPI:
+    """Base of the fake APIs: serves requests on a local port in a background thread"""
+
+    def __init__(self, latency=0., error_rate=0.):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.server = None
+
+    def count_request(self):
+        with self.lock:
+            self.requests += 1
+
+    def start(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeAPIHandler)
+        self.server.daemon_threads = True
+        self.server.api = self
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FakeEspo(FakeAPI):
+    """Stand-in for the EspoCRM API (/api/v1/...)"""
+
+    def __init__(self, entities, streams, **kwargs):
+        super().__init__(**kwargs)
+        self.entities = entities
+        self.streams = streams
+
+    def handle(self, method, path, query, body):
+        parts = path[len('/api/v1/'):].split('/')
+        with self.lock:
+            if method == 'POST' and parts == ['MassAction']:
+                data = json.loads(body)
+                records = self.entities[data['entityType']]
+                for id_ in data['params']['ids']:
+                    records[id_].update(data['data'])
+                return {'count': len(data['params']['ids'])}
+            records = self.entities[parts[0]]
+            if method == 'PUT' and len(parts) == 2:
+                records[parts[1]].update(json.loads(body))
+                return records[parts[1]]
+            if method == 'GET' and len(parts) == 3 and parts[2] == 'stream':
+                stream = self.streams.get(parts[1], [])
+                offset, max_size = int(query.get('offset', 0)), int(query.get('maxSize', 20))
+                return {'total': len(stream), 'list': stream[offset:offset + max_size]}
+            if method == 'GET' and len(parts) == 2:
+                return records[parts[1]]
+            if method == 'GET' and len(parts) == 1:
+                return self.list(records, query)
+        raise KeyError(path)
+
+    @staticmethod
+    def list(records, query):
+        selected = [r for r in records.values() if all(matches(r, c) for c in query.get('where', []))]
+        if 'orderBy' in query:
+            selected.sort(key=lambda r: str(r.get(query['orderBy'])), reverse=query.get('order') == 'desc')
+        offset, max_size = int(query.get('offset', 0)), int(query.get('maxSize', 20))
+        page = selected[offset:offset + max_size]
+        if 'select' in query:
+            fields = query['select'].split(',')
+            page = [{f: r.get(f) for f in fields} for r in page]
+        return {'total': len(selected), 'list': page}
+
+
+class FakeRedRose(FakeAPI):
+    """Stand-in for the RedRose external API (/externalapi/modules/...) and excel import API (/api/...)"""
+
+    def __init__(self, transactions, import_delay=0., **kwargs):
+        super().__init__(**kwargs)
+        self.transactions = transactions
+        self.import_delay = import_delay
+        self.imports = {}
+        self.beneficiaries = 0
+
+    def handle(self, method, path, query, body):
+        action = path.rsplit('/', 1)[-1]
+        if path.startswith('/externalapi/modules/'):
+            if method == 'POST' and action in ['importBeneficiaryWithIqId', 'updateBeneficiaryByIqId']:
+                with self.lock:
+                    self.beneficiaries += 1
+                return {'m': {'id': str(uuid.uuid4())}}
+            if method == 'GET' and action == 'getTransactions':
+                return self.get_transactions(query)
+        if method == 'POST' and path in ['/api/activity/uploadIndividualDistributionExcel',
+                                         '/api/beneficiaryList/updateBeneficiaryListFromExcel']:
+            import_id = str(uuid.uuid4())
+            with self.lock:
+                self.imports[import_id] = time.monotonic()
+            return import_id
+        if method == 'GET' and path.startswith('/api/bulk/getExcelImportStatus/'):
+            with self.lock:
+                started = self.imports[action]
+            done = time.monotonic() - started >= self.import_delay
+            return {'status': 'SUCCEEDED' if done else 'PROCESSING'}
+        raise KeyError(path)
+
+    def get_transactions(self, query):
+        transactions = self.transactions
+        if 'dateFrom' in query:
+            transactions = [t for t in transactions if t['dated'][:10] >= query['dateFrom']]
+        if 'dateTo' in query:
+            transactions = [t for t in transactions if t['dated'][:10] <= query['dateTo']]
+        if 'pageSize' in query:
+            page, page_size = int(query.get('page', 0)), int(query['pageSize'])
+            transactions = transactions[page * page_size:(page + 1) * page_size]
+        return transactions
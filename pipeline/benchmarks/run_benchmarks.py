@@ -0,0 +1,114 @@
+"""
+Run the pipeline steps against local stand-in EspoCRM and RedRose servers and report records per second
+and peak memory, e.g.
+
+    python run_benchmarks.py --size 1000 --size 10000 --workers 8 --output results.json
+"""
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import tempfile
+import time
+import click
+from fake_servers import make_dataset, FakeEspo, FakeRedRose
+
+# mapping of the fields of the synthetic records, shipped with the benchmarks (data/ is not in the repository)
+MAPPING_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_mapping.csv')
+# pipeline options of each benchmark case
+CASES = {
+    'beneficiaries': ['--beneficiaries'],
+    'beneficiaries-bulk': ['--beneficiaries', '--bulk'],
+    'topup': ['--topup'],
+}
+
+
+def peak_memory_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 1024 ** 2 if platform.system() == 'Darwin' else maxrss / 1024
+
+
+def run_pipeline(args, env, work_dir):
+    """Run the pipeline in this (child) process, return its metrics report and peak memory"""
+    os.environ.update(env)
+    os.chdir(work_dir)
+    from pipeline import pipeline
+    logging.getLogger().setLevel(logging.WARNING)
+    metrics_path = os.path.join(work_dir, 'metrics.json')
+    pipeline.main.main(args=args + ['--metrics-json', metrics_path], standalone_mode=False)
+    with open(metrics_path) as f:
+        report = json.load(f)
+    return report, peak_memory_mb()
+
+
+def run_case(case, size, workers, latency, error_rate, import_delay):
+    entities, streams, transactions = make_dataset(size)
+    espo = FakeEspo(entities, streams, latency=latency, error_rate=error_rate).start()
+    redrose = FakeRedRose(transactions, import_delay=import_delay, latency=latency, error_rate=error_rate).start()
+    tmp_dir = tempfile.mkdtemp(prefix='espo2redrose-benchmark-')
+    try:
+        # same layout as the repository: the pipeline runs in a directory next to data/ and credentials/
+        for dir_ in ['data', 'credentials', 'work']:
+            os.makedirs(os.path.join(tmp_dir, dir_))
+        shutil.copy(MAPPING_PATH, os.path.join(tmp_dir, 'data', 'esporedrosemapping.csv'))
+        env = {
+            'ESPOURL': espo.url, 'ESPOAPIKEY': 'benchmark',
+            'RRURL': redrose.url, 'RRAPIUSER': 'benchmark', 'RRAPIKEY': 'benchmark', 'RRMODULE': 'benchmark',
+            'STATEPATH': os.path.join(tmp_dir, 'data', 'state.db'),
+            'IMPORT_POLL_INITIAL_DELAY': '0.1', 'IMPORT_POLL_MAX_DELAY': '1',
+        }
+        args = CASES[case] + ['--workers', str(workers)]
+        # a fresh process for each case, so that peak memory is measured per case
+        start = time.monotonic()
+        with multiprocessing.get_context('spawn').Pool(1) as pool:
+            report, memory = pool.apply(run_pipeline, (args, env, os.path.join(tmp_dir, 'work')))
+        seconds = time.monotonic() - start
+    finally:
+        espo.stop()
+        redrose.stop()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return {
+        'case': case, 'size': size, 'workers': workers, 'latency': latency, 'error_rate': error_rate,
+        'seconds': seconds, 'peak_memory_mb': memory,
+        'requests': {'espo': espo.requests, 'redrose': redrose.requests},
+        'steps': {name: {'records': step['records'], 'seconds': step['seconds'],
+                         'records_per_second': step['records_per_second']}
+                  for name, step in report['steps'].items()},
+    }
+
+
+@click.command()
+@click.option('--case', '-c', 'cases', multiple=True, type=click.Choice(list(CASES)),
+              help="Benchmark case, all cases by default.")
+@click.option('--size', '-s', 'sizes', multiple=True, type=int,
+              help="Number of beneficiaries, payments and transactions, 1000 and 10000 by default.")
+@click.option('--workers', '-w', type=int, default=1, show_default=True, help="Pipeline workers.")
+@click.option('--latency', type=float, default=0., show_default=True,
+              help="Latency added by the fake servers to each request, in seconds.")
+@click.option('--error-rate', type=float, default=0., show_default=True,
+              help="Fraction of requests answered by the fake servers with a 503 error.")
+@click.option('--import-delay', type=float, default=0.5, show_default=True,
+              help="Processing time of RedRose excel imports, in seconds.")
+@click.option('--output', '-o', type=click.Path(dir_okay=False), default=None,
+              help="Write the results to this JSON file.")
+def main(cases, sizes, workers, latency, error_rate, import_delay, output):
+    results = []
+    for size in sizes or [1000, 10000]:
+        for case in cases or list(CASES):
+            result = run_case(case, size, workers, latency, error_rate, import_delay)
+            results.append(result)
+            for name, step in result['steps'].items():
+                print(f"{case:<20} {size:>7} {name:<15} {step['records']:>7} records "
+                      f"{step['seconds']:>8.2f} s {step['records_per_second']:>9.1f} records/s "
+                      f"{result['peak_memory_mb']:>8.1f} MB")
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,7 @@
 Setup.py file.
 Install once-off with:  "pip install ."
 For development:        "pip install -e .[dev]"
+With async clients:     "pip install .[async]"
 """
 import setuptools
 
@@ -25,10 +26,14 @@ setuptools.setup(
             "black",
             "flake8"
         ],
+        "async": [  # async clients, for --async
+            "aiohttp==3.8.1"
+        ],
     },
     entry_points={
         'console_scripts': [
             f"espo2redrose = {PROJECT_NAME}.pipeline:main",
+            f"espo2redrose-merge-reports = {PROJECT_NAME}.metrics:merge_reports",
         ]
     }
 )
\ No newline at end of file
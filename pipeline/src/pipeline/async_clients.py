@@ -0,0 +1,369 @@
+import asyncio
+import json
+import logging
+import random
+import time
+import aiohttp
+from pipeline.espo_api_client import EspoAPI, EspoAPIError
+from pipeline.redrose_api_client import RedRoseAPI, RedRosePaymentsAPI, ExcelImportPoller
+from pipeline.http_session import DEFAULT_MAX_RETRIES, DEFAULT_BACKOFF_FACTOR, DEFAULT_TIMEOUT, body_size
+from pipeline.limiter import retry_after_seconds
+
+# maximum number of open connections of an async session, over all hosts
+DEFAULT_ASYNC_POOL_SIZE = 100
+# methods whose requests are sent again after a read error or a 5xx response
+IDEMPOTENT_METHODS = ['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS']
+RETRY_STATUSES = [500, 502, 503, 504]
+
+
+class AsyncResponse:
+    """Status, headers and content of a response of an async session, read in full"""
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content)
+
+    def __bool__(self):
+        # as a requests response: false for error statuses
+        return self.status_code < 400
+
+
+class AsyncPipelineSession:
+    """Async counterpart of PipelineSession on aiohttp: one pool of keep-alive connections shared by all requests
+    in flight in the event loop, default timeouts, retries with jittered backoff (connection errors for all methods,
+    read errors and 5xx responses only for idempotent methods, 429 responses for all methods), request metrics
+    and, with an AsyncRequestLimiter, the same adaptive limits per host and endpoint class"""
+
+    def __init__(self, pool_size=DEFAULT_ASYNC_POOL_SIZE, max_retries=DEFAULT_MAX_RETRIES,
+                 backoff_factor=DEFAULT_BACKOFF_FACTOR, timeout=DEFAULT_TIMEOUT, keep_alive=True, metrics=None,
+                 limiter=None):
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.timeout = aiohttp.ClientTimeout(sock_connect=timeout[0], sock_read=timeout[1])
+        self.keep_alive = keep_alive
+        self.metrics = metrics
+        self.limiter = limiter
+        self.session = None
+
+    async def __aenter__(self):
+        # the connector must be created in the event loop that uses it
+        connector = aiohttp.TCPConnector(limit=self.pool_size, force_close=not self.keep_alive)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+        return False
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def backoff(self, attempt):
+        return random.uniform(0, self.backoff_factor * 2 ** attempt)
+
+    async def request(self, method, url, params=None, headers=None, json=None, data=None, auth=None):
+        """Send a request and read its response. data may be a function returning the body, called for each
+        attempt (a multipart FormData can be sent only once)."""
+        if auth is not None and not isinstance(auth, aiohttp.BasicAuth):
+            auth = aiohttp.BasicAuth(*auth)
+        kwargs = {'params': params, 'headers': headers, 'json': json, 'auth': auth}
+        for attempt in range(self.max_retries + 1):
+            last_attempt = attempt == self.max_retries
+            kwargs['data'] = data() if callable(data) else data
+            try:
+                response = await self.limited_request(method, url, **kwargs)
+            except aiohttp.ClientConnectorError as e:
+                # no connection, so the request was not sent
+                if last_attempt:
+                    raise
+                delay = self.backoff(attempt)
+                logging.warning(f"{method} {url}: {e}, retrying in {delay:.1f} s")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if last_attempt or method not in IDEMPOTENT_METHODS:
+                    raise
+                delay = self.backoff(attempt)
+                logging.warning(f"{method} {url}: {e!r}, retrying in {delay:.1f} s")
+            else:
+                if response.status_code == 429 and not last_attempt:
+                    delay = retry_after_seconds(response.headers.get('Retry-After'))
+                    if delay is None:
+                        delay = self.backoff_factor * 2 ** attempt
+                    logging.warning(f"{method} {url}: too many requests, retrying in {delay:.1f} s")
+                elif response.status_code in RETRY_STATUSES and method in IDEMPOTENT_METHODS and not last_attempt:
+                    delay = self.backoff(attempt)
+                else:
+                    return response
+            await asyncio.sleep(delay)
+
+    async def limited_request(self, method, url, **kwargs):
+        if self.limiter is None:
+            return await self.measured_request(method, url, **kwargs)
+        async with self.limiter.slot(method, url) as slot:
+            slot['response'] = await self.measured_request(method, url, **kwargs)
+            return slot['response']
+
+    async def measured_request(self, method, url, **kwargs):
+        start = time.monotonic()
+        try:
+            async with self.session.request(method, url, **kwargs) as response:
+                content = await response.read()
+        except Exception:
+            if self.metrics is not None:
+                self.metrics.record_request(method, url, None, time.monotonic() - start)
+            raise
+        if self.metrics is not None:
+            bytes_sent = body_size(json.dumps(kwargs['json'])) if kwargs.get('json') is not None else 0
+            self.metrics.record_request(method, url, response.status, time.monotonic() - start, bytes_sent,
+                                        len(content))
+        return AsyncResponse(response.status, response.headers, content)
+
+
+def form_data(files):
+    """Function returning a new multipart body with the files of a requests call, for each attempt"""
+    def make():
+        data = aiohttp.FormData()
+        for name, (filename, content, content_type) in files:
+            data.add_field(name, content, filename=filename, content_type=content_type)
+        return data
+    return make
+
+
+class AsyncEspoAPI:
+    """EspoAPI with coroutine methods, on an async session"""
+
+    url_path = EspoAPI.url_path
+    # URLs, request bodies, response checks and the steps of mass updates are those of the sync client
+    request_kwargs = EspoAPI.request_kwargs
+    check_response = staticmethod(EspoAPI.check_response)
+    normalize_url = EspoAPI.normalize_url
+    mass_action_params = staticmethod(EspoAPI.mass_action_params)
+    mass_update_done = staticmethod(EspoAPI.mass_update_done)
+    skip_missing = staticmethod(EspoAPI.skip_missing)
+    update_groups = staticmethod(EspoAPI.update_groups)
+
+    def __init__(self, url, api_key, session):
+        self.url = url
+        self.api_key = api_key
+        self.status_code = None
+        self.session = session
+
+    async def request(self, method, action, params=None):
+        if params is None:
+            params = {}
+        response = await self.session.request(method, **self.request_kwargs(method, action, params))
+        self.status_code = response.status_code
+        self.check_response(response)
+        return response.json()
+
+    async def request_list(self, action, params=None, max_size=200):
+        """Iterate (async for) over all records of a list request, walking the pages with offset/maxSize.
+        The next page is requested while the caller works on the current one."""
+        params = dict(params) if params is not None else {}
+        # a stable order is needed so that pages don't overlap or skip records
+        params.setdefault('orderBy', 'id')
+        params.setdefault('order', 'asc')
+
+        async def get_page(offset):
+            return (await self.request('GET', action, {**params, 'offset': offset, 'maxSize': max_size}))['list']
+
+        next_page = None
+        try:
+            offset = 0
+            page = await get_page(offset)
+            while page:
+                if len(page) == max_size:
+                    next_page = asyncio.ensure_future(get_page(offset + max_size))
+                for record in page:
+                    yield record
+                if next_page is None:
+                    break
+                offset += max_size
+                page, next_page = await next_page, None
+        finally:
+            if next_page is not None:
+                next_page.cancel()
+
+    async def mass_update(self, entity_type, ids, data, batch_size=200):
+        """Apply the same changes to many records with EspoCRM mass updates of up to batch_size records.
+        If a mass update fails, its records are updated concurrently one by one, skipping those that no longer
+        exist."""
+        ids = list(ids)
+        for i in range(0, len(ids), batch_size):
+            batch_ids = ids[i:i + batch_size]
+            if len(batch_ids) > 1:
+                try:
+                    result = await self.request('POST', 'MassAction',
+                                                self.mass_action_params(entity_type, batch_ids, data))
+                    if self.mass_update_done(entity_type, batch_ids, result):
+                        continue
+                except EspoAPIError as e:
+                    logging.warning(f'mass update of {entity_type} failed ({e}), updating records one by one')
+            await asyncio.gather(*(self.update_existing(entity_type, id_, data) for id_ in batch_ids))
+
+    async def update_existing(self, entity_type, id_, data):
+        try:
+            await self.request('PUT', f'{entity_type}/{id_}', data)
+        except EspoAPIError as e:
+            self.skip_missing(e, entity_type, id_)
+
+    async def batch_update(self, entity_type, updates, batch_size=200):
+        """Apply a list of (id, data) updates, grouping records with identical changes in mass updates"""
+        for data, ids in self.update_groups(updates):
+            await self.mass_update(entity_type, ids, data, batch_size)
+
+
+class AsyncRedRoseAPI:
+    """RedRoseAPI with coroutine methods, on an async session"""
+
+    url_path = RedRoseAPI.url_path
+    transactions_date_from_param = RedRoseAPI.transactions_date_from_param
+    transactions_date_to_param = RedRoseAPI.transactions_date_to_param
+    transactions_page_param = RedRoseAPI.transactions_page_param
+    transactions_page_size_param = RedRoseAPI.transactions_page_size_param
+    # URLs, request bodies, response checks and the paging of transactions are those of the sync client
+    request_url = RedRoseAPI.request_url
+    key_value_files = staticmethod(RedRoseAPI.key_value_files)
+    check_response = staticmethod(RedRoseAPI.check_response)
+    normalize_url = RedRoseAPI.normalize_url
+    transactions_params = RedRoseAPI.transactions_params
+    page_params = RedRoseAPI.page_params
+    read_page = RedRoseAPI.read_page
+    respects_query = RedRoseAPI.respects_query
+
+    def __init__(self, url, api_user, api_key, module, session):
+        self.url = url
+        self.api_user = api_user
+        self.api_key = api_key
+        self.module = module
+        self.status_code = None
+        self.session = session
+
+    async def request(self, method, action, params=None, files=None):
+        data = form_data(self.key_value_files(files)) if files is not None else None
+        response = await self.session.request(method, self.request_url(action, params), data=data,
+                                              auth=(self.api_user, self.api_key))
+        self.status_code = response.status_code
+        self.check_response(response)
+        return response.json()
+
+    async def get_transactions(self, date_from=None, date_to=None, page_size=None):
+        """Iterate (async for) over transactions, optionally only those between two dates (YYYY-MM-DD)
+        and page by page"""
+        params = self.transactions_params(date_from, date_to)
+        if page_size is None:
+            for transaction in await self.request('GET', 'getTransactions', params=params or None):
+                yield transaction
+            return
+
+        page, seen_ids = 0, set()
+        while True:
+            transactions = await self.request('GET', 'getTransactions',
+                                              params=self.page_params(params, page, page_size))
+            new_transactions, last_page = self.read_page(transactions, seen_ids, page, date_from, date_to, page_size)
+            for transaction in new_transactions:
+                yield transaction
+            if last_page:
+                break
+            page += 1
+
+
+class AsyncRedRosePaymentsAPI:
+    """RedRosePaymentsAPI with coroutine methods, on an async session"""
+
+    # paths, query parameters and response handling are those of the sync client
+    beneficiary_list_path = RedRosePaymentsAPI.beneficiary_list_path
+    import_status_path = RedRosePaymentsAPI.import_status_path
+    download_distribution_path = RedRosePaymentsAPI.download_distribution_path
+    upload_distribution_path = RedRosePaymentsAPI.upload_distribution_path
+    beneficiary_group_path = RedRosePaymentsAPI.beneficiary_group_path
+    beneficiary_list_params = staticmethod(RedRosePaymentsAPI.beneficiary_list_params)
+    download_distribution_params = staticmethod(RedRosePaymentsAPI.download_distribution_params)
+    upload_distribution_params = staticmethod(RedRosePaymentsAPI.upload_distribution_params)
+    beneficiary_group_params = staticmethod(RedRosePaymentsAPI.beneficiary_group_params)
+    parse_response = staticmethod(RedRosePaymentsAPI.parse_response)
+    new_import_id = staticmethod(RedRosePaymentsAPI.new_import_id)
+    base_url = RedRosePaymentsAPI.base_url
+
+    def __init__(self, host_name=None, user_name=None, password=None, session=None):
+        self.host_name = host_name
+        self.auth = (user_name, password)
+        self.session = session
+
+    async def update_beneficiary_list_from_excel(self, comment, filename, file_path=None, file_content=None):
+        response = await self._post(
+            self.beneficiary_list_path,
+            params=self.beneficiary_list_params(comment),
+            data=self._form_excel('file', filename, file_path, file_content)
+        )
+        return self.parse_response(response, 'update_beneficiary_list_from_excel', self.new_import_id)
+
+    async def get_excel_import_status(self, excel_import_id):
+        response = await self._get(self.import_status_path + excel_import_id, params=None)
+        return self.parse_response(response, 'get_excel_import_status', {'status': 'SUCCEEDED'})
+
+    async def download_individual_distribution_excel(self, beneficiary_group_id, activity_id, local_file_name):
+        if not self.host_name:
+            return None
+        response = await self._get(self.download_distribution_path,
+                                   params=self.download_distribution_params(beneficiary_group_id, activity_id))
+        if not response:
+            raise Exception('download_individual_distribution_excel failed, status code: ' +
+                            str(response.status_code))
+        local_filename = 'xlsx/' + local_file_name
+        with open(local_filename, 'wb') as f:
+            f.write(response.content)
+        return local_filename
+
+    async def upload_individual_distribution_excel(self, filename, file_path=None, activity_id=None,
+                                                   file_content=None):
+        response = await self._post(
+            self.upload_distribution_path,
+            params=self.upload_distribution_params(activity_id),
+            data=self._form_excel('distFile', filename, file_path, file_content) if self.host_name else None
+        )
+        return self.parse_response(response, 'upload_individual_distribution_excel', self.new_import_id)
+
+    async def get_beneficiary_group(self, beneficiary_group_name):
+        response = await self._get(self.beneficiary_group_path,
+                                   params=self.beneficiary_group_params(beneficiary_group_name))
+        return self.parse_response(response, 'get_beneficiary_group')
+
+    @staticmethod
+    def _form_excel(file_param, filename, file_path=None, file_content=None):
+        # the excel file is sent from memory (file_content, bytes) or read from disk (file_path)
+        return form_data(RedRosePaymentsAPI._files_excel(file_param, filename, file_path, file_content))
+
+    async def _get(self, url, params):
+        if not self.host_name:
+            return None
+        return await self.session.request("GET", self.base_url() + url, params=params, auth=self.auth)
+
+    async def _post(self, url, params, data):
+        if not self.host_name:
+            return None
+        return await self.session.request("POST", self.base_url() + url, params=params, data=data, auth=self.auth)
+
+
+class AsyncExcelImportPoller(ExcelImportPoller):
+    """ExcelImportPoller for an async client: waiting for an import does not block the event loop"""
+
+    async def wait(self, excel_import_id):
+        """Return the final import status, or a status 'TIMEOUT' if it is not known within deadline/budget"""
+        start = time.monotonic()
+        delay = self.initial_delay
+        polls = 0
+        while True:
+            upload_result = await self.client.get_excel_import_status(excel_import_id)
+            polls += 1
+            upload_result, wait = self.check(upload_result, polls, start, delay)
+            if upload_result is not None:
+                return upload_result
+            await asyncio.sleep(wait)
+            delay = min(delay * self.backoff, self.max_delay)
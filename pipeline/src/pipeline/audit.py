@@ -0,0 +1,186 @@
+import logging
+import os
+import base64
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+from pipeline.excel import write_rows
+from pipeline.values import is_missing
+
+# payment fields shown in the audit file
+AUDIT_PAYMENT_FIELDS = ['id', 'shelterID', 'shelterId', 'shelterName', 'date', 'amount', 'amountCurrency', 'status',
+                        'numPayment', 'numberOfPayments', 'modifiedAt']
+# number of shelters per list query and of concurrent stream requests
+SHELTER_BATCH_SIZE = 100
+STREAM_WORKERS = 8
+# columns of the sheets of the audit file
+OVERVIEW_COLUMNS = ['shelterID', 'amount', 'amountCurrency', 'Payment Status', 'numPayment', 'numberOfPayments',
+                    'Payment to', 'Beneficiary Name', 'Beneficiary Status', 'Accomodation Type', 'gh0', 'gh1',
+                    'reasonIbanChange']
+CHANGES_COLUMNS = ['shelterID', 'Changes', 'createdAt', 'createdByName', 'Link']
+# bytes of the audit file encoded at a time for the email attachment
+BASE64_CHUNK_SIZE = 3 * 1024 * 1024
+
+
+def make_hyperlink(espo_url, value):
+    url = f"{espo_url}/#Shelter/view/"+"{}"
+    linkname = "Link to profile"
+    return '=HYPERLINK("%s", "%s")' % (url.format(value), linkname)
+
+
+def get_shelters(espo_client, shelter_ids, batch_size=SHELTER_BATCH_SIZE):
+    """Get Shelter records with one list query per batch of ids, in the order of shelter_ids"""
+    shelters = {}
+    for i in range(0, len(shelter_ids), batch_size):
+        params = {
+            "where": [
+                {
+                    "type": "in",
+                    "attribute": "id",
+                    "value": list(shelter_ids[i:i + batch_size])
+                }
+            ]
+        }
+        for shelter in espo_client.request_list('Shelter', params):
+            shelters[shelter['id']] = shelter
+    return [shelters[id] for id in shelter_ids if id in shelters]
+
+
+def get_stream(espo_client, id):
+    """All the notes of the stream of a Shelter, read page by page"""
+    return list(espo_client.request_list(f"Shelter/{id}/stream"))
+
+
+def get_streams(espo_client, shelter_ids, workers=STREAM_WORKERS):
+    """Iterate over the stream of each Shelter, fetched concurrently, in the order of shelter_ids.
+    At most 2 * workers streams are fetched ahead of the caller, so memory does not grow with the batch."""
+    window = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            for id in shelter_ids:
+                window.append(executor.submit(get_stream, espo_client, id))
+                if len(window) >= 2 * workers:
+                    yield window.popleft().result()
+            while window:
+                yield window.popleft().result()
+        finally:
+            for future in window:
+                future.cancel()
+
+
+def payment_to(shelter):
+    # missing if either name is missing, as with pandas string concatenation
+    if is_missing(shelter.get('rrName')) or is_missing(shelter.get('rrSurname')):
+        return None
+    return shelter['rrName'] + " " + shelter['rrSurname']
+
+
+def overview_rows(payments, shelters_by_shelter_id):
+    """Rows of the Payment Overview sheet: each payment joined with its shelter(s), as a left join"""
+    for payment in payments:
+        for shelter in shelters_by_shelter_id.get(payment.get('shelterID'), [{}]):
+            yield [payment.get('shelterID'), payment.get('amount'), payment.get('amountCurrency'),
+                   payment.get('status'), payment.get('numPayment'), payment.get('numberOfPayments'),
+                   payment_to(shelter) if shelter else None, shelter.get('contactName'), shelter.get('status'),
+                   shelter.get('accType'), shelter.get('gh0'), shelter.get('gh1'), shelter.get('reasonIbanChange')]
+
+
+def change_rows(streams, shelter_ids_by_id, espo_url):
+    """Rows of the Changes sheet: the updates in the streams of the shelters"""
+    for stream in streams:
+        for change in stream:
+            if change.get('type') != 'Update':
+                continue
+            yield [shelter_ids_by_id.get(change.get('parentId')), change.get('data'), change.get('createdAt'),
+                   change.get('createdByName'), make_hyperlink(espo_url, change.get('parentId'))]
+
+
+def create_audit_file(espo_client, path, espo_url, payments_params=None):
+    """Write the audit file of pending payments, selected in EspoCRM with payments_params if given.
+    Rows are written to disk as they are produced (xlsxwriter constant_memory mode), with payments joined
+    to shelters through a dict index.
+    Returns the number of payments in the audit file, 0 if there are none (the file is then not written)."""
+    import xlsxwriter
+
+    # Get due payments
+    payments = [p for p in espo_client.request_list_cached("Payment", payments_params) if p['status'] == "Pending"]
+    logging.info(f"{len(payments)} pending payments")
+
+    # Get associated shelters, indexed by shelterID (to join payments) and by EspoCRM ID (to join changes)
+    shelter_ids = list(dict.fromkeys(p['shelterId'] for p in payments))
+    shelters = get_shelters(espo_client, shelter_ids)
+    if len(shelters) == 0:
+        return 0
+    shelters_by_shelter_id = {}
+    for shelter in shelters:
+        shelters_by_shelter_id.setdefault(shelter.get('shelterID'), []).append(shelter)
+    shelter_ids_by_id = {shelter['id']: shelter.get('shelterID') for shelter in shelters}
+
+    workbook = xlsxwriter.Workbook(path, {'constant_memory': True})
+    # header format of pandas.DataFrame.to_excel
+    header = workbook.add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'})
+
+    overview = workbook.add_worksheet('Payment Overview')
+    overview.write_row(0, 0, OVERVIEW_COLUMNS, header)
+    nrows = write_rows(overview, overview_rows(payments, shelters_by_shelter_id), start_row=1)
+
+    # Get changes for beneficiaries associated to payments
+    changes = workbook.add_worksheet('Changes')
+    rows = change_rows(get_streams(espo_client, shelter_ids), shelter_ids_by_id, espo_url)
+    first_row = next(rows, None)
+    if first_row is None:
+        changes.write(0, 0, 'Paymentchanges', header)
+        changes.write(1, 0, 'no payment info was changed by users in this batch')
+    else:
+        changes.write_row(0, 0, CHANGES_COLUMNS, header)
+        write_rows(changes, chain([first_row], rows), start_row=1)
+
+    # Save audit file
+    workbook.close()
+    return nrows
+
+
+def encode_file(path, chunk_size=BASE64_CHUNK_SIZE):
+    """Base64 of a file, encoded a chunk at a time (chunk_size is a multiple of 3, so chunks concatenate)"""
+    parts = []
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            parts.append(base64.b64encode(chunk).decode('ascii'))
+    return ''.join(parts)
+
+
+def send_audit_file(path):
+    from sendgrid import SendGridAPIClient
+    from sendgrid.helpers.mail import Mail, To, Attachment, FileContent, FileName, FileType, Disposition
+    email_from = os.getenv("AUDIT_EMAIL_FROM")
+    email_to1 = os.getenv("AUDIT_EMAIL_TO_1")
+    email_to2 = os.getenv("AUDIT_EMAIL_TO_2")
+    email_to3 = os.getenv("AUDIT_EMAIL_TO_3")
+    email_to4 = os.getenv("AUDIT_EMAIL_TO_4")
+    # Send emails around
+    if email_from is not None and email_to1 is not None and email_to2 is not None and email_to3 is not None and email_to4 is not None:
+        message = Mail(
+            from_email=email_from,
+            to_emails=[To(email_to1), To(email_to2), To(email_to3), To(email_to4)],
+            subject='Shelter Auditfile',
+            html_content='This is the audit file for the sheltertopup of today')
+
+        encoded_file = encode_file(path)
+
+        attachedFile = Attachment(
+            FileContent(encoded_file),
+            FileName(os.path.basename(path)),
+            FileType('application/xlsx'),
+            Disposition('attachment')
+        )
+        message.attachment = attachedFile
+
+        try:
+            logging.info(f"SENDGRID_API_KEY {os.getenv('SENDGRID_API_KEY')}")
+            sg = SendGridAPIClient(os.getenv("SENDGRID_API_KEY"))
+            response = sg.send(message)
+            logging.info(response.status_code)
+            logging.info(response.body)
+            logging.info(response.headers)
+        except Exception as e:
+            logging.error(e)
@@ -0,0 +1,433 @@
+import asyncio
+import logging
+import threading
+import hashlib
+import json
+from datetime import datetime
+from itertools import islice
+from pipeline.redrose_api_client import RedRoseAPIError
+from pipeline.concurrency import BoundedExecutor
+from pipeline.mapper import FieldMapper
+from pipeline.excel import write_workbook
+from pipeline.values import is_missing
+from pipeline.sharding import in_shard
+
+# maximum number of beneficiaries per excel import
+BULK_IMPORT_SIZE = 5000
+
+
+def redrose_id_update(rr_data, entity_name, entity):
+    """EspoCRM action and data writing the RedRose id of a response back, or None if it has no id"""
+    if 'm' in rr_data.keys():
+        if 'id' in rr_data['m'].keys():
+            return f"{entity_name}/{entity['id']}", {"redroseInternalID": f"{rr_data['m']['id']}"}
+    return None
+
+
+def update_redrose_id(rr_data, entity_name, entity, espo_client, journal=None):
+    update = redrose_id_update(rr_data, entity_name, entity)
+    if update is not None:
+        espo_client.request('PUT', *update)
+        if journal is not None:
+            journal.append('beneficiaries', 'writeback', entity=entity_name, id=entity['id'])
+
+
+def iter_batches(items, batch_size):
+    iterator = iter(items)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def iter_payloads(entities, mapper, batch_mapping=False, batch_size=200):
+    """Yield (entity, payload) pairs, mapping records one by one or a page at a time"""
+    if not batch_mapping:
+        for entity in entities:
+            yield entity, mapper.map(entity)
+        return
+    for batch in iter_batches(entities, batch_size):
+        yield from zip(batch, mapper.map_batch(batch))
+
+
+def payload_hash(payload):
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def is_new(entity):
+    # an empty id, as left by EspoCRM forms, means the beneficiary is not in RedRose yet
+    return is_missing(entity["redroseInternalID"]) or entity["redroseInternalID"] == ""
+
+
+def is_unchanged(payload, hash_, state_store, force_refresh=False):
+    """True if the payload is the same as the last one accepted by RedRose for this beneficiary"""
+    if state_store is None or force_refresh:
+        return False
+    return state_store.get_payload_hash(payload['m.iqId']) == hash_
+
+
+def is_known(payload, state_store):
+    """True if RedRose accepted a payload for this beneficiary before, e.g. in an excel import that did not report
+    its RedRose id"""
+    return state_store is not None and state_store.get_payload_hash(payload['m.iqId']) is not None
+
+
+def push_request(entity, payload, state_store=None, force_refresh=False, verbose=False):
+    """Action of a beneficiary push ('created', 'updated' or 'skipped') and the arguments of its RedRose request
+    (None if skipped)"""
+    if is_new(entity) and not is_known(payload, state_store):  # create new beneficiary
+        if verbose:
+            logging.info(f'creating beneficiary: {payload}')
+        return 'created', {'method': 'POST', 'action': 'importBeneficiaryWithIqId', 'files': payload}
+    # if beneficiary already exists, update it
+    hash_ = payload_hash(payload) if state_store is not None else None
+    if is_unchanged(payload, hash_, state_store, force_refresh):
+        if verbose:
+            logging.info(f"beneficiary {payload['m.iqId']} unchanged, skipping update")
+        return 'skipped', None
+    if verbose:
+        logging.info(f'updating beneficiary: {payload}')
+    return 'updated', {'method': 'POST', 'action': 'updateBeneficiaryByIqId',
+                       'params': {'beneficiaryIqId': payload['m.iqId']}, 'files': payload}
+
+
+def push_beneficiary(entity, payload, redrose_client, state_store=None, force_refresh=False, verbose=False):
+    """Create or update one beneficiary in RedRose.
+    If a state store is given, updates whose payload is identical to the last one accepted by RedRose are skipped.
+    Returns the action performed ('created', 'updated' or 'skipped') and the RedRose response, or ('failed', None)"""
+    action, request = push_request(entity, payload, state_store, force_refresh, verbose)
+    if request is None:
+        return action, None
+    try:
+        rr_data = redrose_client.request(**request)
+    except RedRoseAPIError:
+        logging.error('create beneficiary failed!' if action == 'created' else 'update failed!')
+        return 'failed', None
+    if state_store is not None:
+        state_store.set_payload_hash(payload['m.iqId'], payload_hash(payload))
+    return action, rr_data
+
+
+def journal_push(journal, entity_name, entity, payload, rr_id=None):
+    # rr_id is the RedRose id of a new beneficiary, still to be written back to EspoCRM
+    journal.append('beneficiaries', 'push', entity=entity_name, id=entity['id'], hash=payload_hash(payload),
+                   redroseId=rr_id)
+
+
+def completed_pushes(journal, entity_name):
+    """Beneficiaries of an entity pushed by an interrupted run, by EspoCRM id, with the RedRose id
+    still to be written back (None if there is none)"""
+    if journal is None:
+        return {}
+    pushes = {r['id']: r for r in journal.find('beneficiaries', 'push') if r['entity'] == entity_name}
+    for record in journal.find('beneficiaries', 'writeback'):
+        if record['entity'] == entity_name and record['id'] in pushes:
+            pushes[record['id']] = {**pushes[record['id']], 'redroseId': None}
+    return pushes
+
+
+def resume_push(pushes, entity, payload):
+    """Journal record of a beneficiary already pushed with the same payload, or None"""
+    pushed = pushes.get(entity['id'])
+    if pushed is not None and pushed['hash'] == payload_hash(payload):
+        return pushed
+    return None
+
+
+def list_entities(espo_client, entity_name, params=None, shard=None):
+    """Iterate over the records of an entity, or only over those of a shard (i, n)"""
+    entities = espo_client.request_list(entity_name, params, prefetch=True)
+    if shard is None:
+        return entities
+    return (entity for entity in entities if in_shard(entity['id'], shard))
+
+
+class SyncStats:
+    """Thread-safe counters of the outcome of a beneficiary sync"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {'created': 0, 'updated': 0, 'skipped': 0, 'resumed': 0, 'failed': 0}
+
+    def add(self, action, count=1):
+        with self.lock:
+            self.counts[action] = self.counts.get(action, 0) + count
+
+    def __getitem__(self, action):
+        return self.counts.get(action, 0)
+
+
+def modified_since_params(watermark):
+    """EspoCRM query for records modified after the watermark or not yet pushed to RedRose"""
+    return {
+        "where": [
+            {
+                "type": "or",
+                "value": [
+                    {
+                        "type": "after",
+                        "attribute": "modifiedAt",
+                        "value": watermark
+                    },
+                    {
+                        "type": "isNull",
+                        "attribute": "redroseInternalID"
+                    },
+                    {
+                        "type": "equals",
+                        "attribute": "redroseInternalID",
+                        "value": ""
+                    }
+                ]
+            }
+        ]
+    }
+
+
+def sync_beneficiaries(entity_name, mapping, espo_client, redrose_client, workers=1, params=None,
+                       state_store=None, force_refresh=False, batch_mapping=False, journal=None, shard=None,
+                       verbose=False):
+    """Create or update in RedRose all beneficiaries of an EspoCRM entity (optionally filtered by params).
+    With workers > 1, records go through bounded concurrent stages: fetching (page prefetch),
+    payload mapping (this thread), RedRose pushes and EspoCRM write-backs (one thread pool each).
+    With a journal, beneficiaries already pushed by an interrupted run are not pushed again.
+    With a shard (i, n), only the records whose id hashes to shard i are synced."""
+    stats = SyncStats()
+    # mark all beneficiaries as approved
+    mapper = FieldMapper.from_rows(mapping, fixed_values={'m.beneficiaryStatus': 'Approved'})
+    entities = list_entities(espo_client, entity_name, params, shard)
+    payloads = iter_payloads(entities, mapper, batch_mapping)
+    pushes = completed_pushes(journal, entity_name)
+
+    def push(entity, payload, write_back):
+        pushed = resume_push(pushes, entity, payload)
+        if pushed is not None:
+            # only the write-back of the RedRose id may be missing
+            stats.add('resumed')
+            if pushed['redroseId'] is not None:
+                write_back(update_redrose_id, {'m': {'id': pushed['redroseId']}}, entity_name, entity, espo_client,
+                           journal)
+            return
+        action, rr_data = push_beneficiary(entity, payload, redrose_client, state_store, force_refresh, verbose)
+        stats.add(action)
+        if journal is not None and action in ['created', 'updated']:
+            rr_id = rr_data.get('m', {}).get('id') if action == 'created' else None
+            journal_push(journal, entity_name, entity, payload, rr_id)
+        if action == 'created':
+            write_back(update_redrose_id, rr_data, entity_name, entity, espo_client, journal)
+
+    if workers <= 1:
+        for entity, payload in payloads:
+            push(entity, payload, lambda fn, *args: fn(*args))
+        return stats
+
+    # the push pool is closed first, as its tasks hand records over to the write-back pool
+    with BoundedExecutor(workers) as write_pool, BoundedExecutor(workers) as push_pool:
+        for entity, payload in payloads:
+            push_pool.submit(push, entity, payload, write_pool.submit)
+    return stats
+
+
+async def update_redrose_id_async(rr_data, entity_name, entity, espo_client, journal=None):
+    """update_redrose_id for an async EspoCRM client"""
+    update = redrose_id_update(rr_data, entity_name, entity)
+    if update is not None:
+        await espo_client.request('PUT', *update)
+        if journal is not None:
+            journal.append('beneficiaries', 'writeback', entity=entity_name, id=entity['id'])
+
+
+async def push_beneficiary_async(entity, payload, redrose_client, state_store=None, force_refresh=False,
+                                 verbose=False):
+    """push_beneficiary for an async RedRose client"""
+    action, request = push_request(entity, payload, state_store, force_refresh, verbose)
+    if request is None:
+        return action, None
+    try:
+        rr_data = await redrose_client.request(**request)
+    except RedRoseAPIError:
+        logging.error('create beneficiary failed!' if action == 'created' else 'update failed!')
+        return 'failed', None
+    if state_store is not None:
+        state_store.set_payload_hash(payload['m.iqId'], payload_hash(payload))
+    return action, rr_data
+
+
+async def iter_payloads_async(entities, mapper, batch_mapping=False, batch_size=200):
+    """iter_payloads over an async iterator of entities"""
+    batch = []
+    async for entity in entities:
+        if not batch_mapping:
+            yield entity, mapper.map(entity)
+            continue
+        batch.append(entity)
+        if len(batch) >= batch_size:
+            for pair in zip(batch, mapper.map_batch(batch)):
+                yield pair
+            batch = []
+    if batch:
+        for pair in zip(batch, mapper.map_batch(batch)):
+            yield pair
+
+
+async def list_entities_async(espo_client, entity_name, params=None, shard=None):
+    """list_entities for an async EspoCRM client"""
+    async for entity in espo_client.request_list(entity_name, params):
+        if shard is None or in_shard(entity['id'], shard):
+            yield entity
+
+
+async def sync_beneficiaries_async(entity_name, mapping, espo_client, redrose_client, concurrency=100, params=None,
+                                   state_store=None, force_refresh=False, batch_mapping=False, journal=None,
+                                   shard=None, verbose=False):
+    """sync_beneficiaries with async clients: up to concurrency beneficiaries are pushed (and their RedRose ids
+    written back) at the same time from one event loop, instead of one thread per request in flight"""
+    stats = SyncStats()
+    # mark all beneficiaries as approved
+    mapper = FieldMapper.from_rows(mapping, fixed_values={'m.beneficiaryStatus': 'Approved'})
+    entities = list_entities_async(espo_client, entity_name, params, shard)
+    pushes = completed_pushes(journal, entity_name)
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks = set()
+    errors = []
+
+    async def push(entity, payload):
+        try:
+            pushed = resume_push(pushes, entity, payload)
+            if pushed is not None:
+                # only the write-back of the RedRose id may be missing
+                stats.add('resumed')
+                if pushed['redroseId'] is not None:
+                    await update_redrose_id_async({'m': {'id': pushed['redroseId']}}, entity_name, entity,
+                                                  espo_client, journal)
+                return
+            action, rr_data = await push_beneficiary_async(entity, payload, redrose_client, state_store,
+                                                           force_refresh, verbose)
+            stats.add(action)
+            if journal is not None and action in ['created', 'updated']:
+                rr_id = rr_data.get('m', {}).get('id') if action == 'created' else None
+                journal_push(journal, entity_name, entity, payload, rr_id)
+            if action == 'created':
+                await update_redrose_id_async(rr_data, entity_name, entity, espo_client, journal)
+        finally:
+            semaphore.release()
+
+    def done(task):
+        tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            errors.append(task.exception())
+
+    try:
+        async for entity, payload in iter_payloads_async(entities, mapper, batch_mapping):
+            # stop at the first failed task, as BoundedExecutor does
+            if errors:
+                raise errors[0]
+            await semaphore.acquire()
+            task = asyncio.ensure_future(push(entity, payload))
+            tasks.add(task)
+            task.add_done_callback(done)
+    finally:
+        # let the pushes in flight finish, so that their outcome is journaled
+        await asyncio.gather(*tasks, return_exceptions=True)
+    if errors:
+        raise errors[0]
+    return stats
+
+
+def find_imported_ids(upload_result):
+    """Map m.iqId to RedRose id for the imported rows listed in an excel import status, if any"""
+    imported_ids = {}
+    for value in upload_result.values():
+        if not isinstance(value, list):
+            continue
+        for row in value:
+            if not isinstance(row, dict):
+                continue
+            iq_id = row.get('m.iqId', row.get('iqId'))
+            rr_id = row.get('m.id', row.get('id'))
+            if iq_id is not None and rr_id is not None:
+                imported_ids[str(iq_id)] = rr_id
+    return imported_ids
+
+
+def import_beneficiaries(chunk, entity_name, espo_client, redrose_pay_client, poller, stats, state_store=None,
+                         workers=1, journal=None, verbose=False):
+    """Create or update a chunk of (entity, payload) in RedRose with one excel import matched on m.iqId,
+    then write the RedRose ids of new beneficiaries reported by the import status back to EspoCRM"""
+    fields = list(dict.fromkeys(field for _, payload in chunk for field in payload))
+    # RedRose reads the field names in the second row (headerRowIndex 1)
+    content = write_workbook(fields, ([payload.get(field) for field in fields] for _, payload in chunk),
+                             title_row=fields)
+    filename = f"Beneficiaries-{entity_name}-{datetime.today().strftime('%Y%m%d%H%M%S')}.xlsx"
+    if verbose:
+        logging.info(f'importing {len(chunk)} beneficiaries with {filename}')
+    import_id = redrose_pay_client.update_beneficiary_list_from_excel(
+        comment=f'espo2redrose {entity_name}', filename=filename, file_content=content)
+    upload_result = poller.wait(import_id)
+    if upload_result['status'] != 'SUCCEEDED':
+        logging.error(f"import of {len(chunk)} beneficiaries ({filename}) failed, status {upload_result['status']}")
+        stats.add('failed', len(chunk))
+        return
+
+    new = [(entity, payload) for entity, payload in chunk if is_new(entity)]
+    stats.add('updated', len(chunk) - len(new))
+    stats.add('created', len(new))
+    imported_ids = find_imported_ids(upload_result)
+    if state_store is not None:
+        for _, payload in chunk:
+            state_store.set_payload_hash(payload['m.iqId'], payload_hash(payload))
+    if journal is not None:
+        for entity, payload in chunk:
+            rr_id = imported_ids.get(str(payload['m.iqId'])) if is_new(entity) else None
+            journal_push(journal, entity_name, entity, payload, rr_id)
+
+    # write the RedRose ids of new beneficiaries back to EspoCRM
+    missing = [payload['m.iqId'] for _, payload in new if str(payload['m.iqId']) not in imported_ids]
+    if missing:
+        # no documented RedRose endpoint returns the ids of many beneficiaries at once, so these are not
+        # looked up; the state store keeps them from being created again
+        logging.warning(f'RedRose ids of {len(missing)} new beneficiaries not reported by the import status, '
+                        f'their redroseInternalID stays empty')
+        if verbose:
+            logging.info(f'beneficiaries without RedRose id: {missing}')
+    with BoundedExecutor(max(workers, 1)) as write_pool:
+        for entity, payload in new:
+            rr_id = imported_ids.get(str(payload['m.iqId']))
+            if rr_id is not None:
+                write_pool.submit(update_redrose_id, {'m': {'id': rr_id}}, entity_name, entity, espo_client,
+                                  journal)
+
+
+def sync_beneficiaries_bulk(entity_name, mapping, espo_client, redrose_pay_client, poller, workers=1, params=None,
+                            state_store=None, force_refresh=False, batch_mapping=False, journal=None, shard=None,
+                            verbose=False):
+    """Create or update in RedRose all new or changed beneficiaries of an EspoCRM entity with excel imports
+    of up to BULK_IMPORT_SIZE records, instead of one request per beneficiary"""
+    stats = SyncStats()
+    mapper = FieldMapper.from_rows(mapping, fixed_values={'m.beneficiaryStatus': 'Approved'})
+    entities = list_entities(espo_client, entity_name, params, shard)
+    pushes = completed_pushes(journal, entity_name)
+
+    chunk = []
+    for entity, payload in iter_payloads(entities, mapper, batch_mapping):
+        pushed = resume_push(pushes, entity, payload)
+        if pushed is not None:
+            # imported by an interrupted run, only the write-back of the RedRose id may be missing
+            stats.add('resumed')
+            if pushed['redroseId'] is not None:
+                update_redrose_id({'m': {'id': pushed['redroseId']}}, entity_name, entity, espo_client, journal)
+            continue
+        # beneficiaries imported before whose RedRose id was not reported are not imported again either
+        if is_unchanged(payload, payload_hash(payload), state_store, force_refresh):
+            stats.add('skipped')
+            continue
+        chunk.append((entity, payload))
+        if len(chunk) >= BULK_IMPORT_SIZE:
+            import_beneficiaries(chunk, entity_name, espo_client, redrose_pay_client, poller, stats, state_store,
+                                 workers, journal, verbose)
+            chunk = []
+    if chunk:
+        import_beneficiaries(chunk, entity_name, espo_client, redrose_pay_client, poller, stats, state_store,
+                             workers, journal, verbose)
+    return stats
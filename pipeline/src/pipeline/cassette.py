@@ -0,0 +1,150 @@
+import base64
+import gzip
+import hashlib
+import json
+import threading
+import time
+from datetime import timedelta
+from urllib.parse import urlparse
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+# response headers that are not worth recording
+# (the content is stored decoded, so its original length and encoding do not apply)
+SKIPPED_HEADERS = ['set-cookie', 'date', 'server', 'connection', 'keep-alive', 'transfer-encoding',
+                   'content-encoding', 'content-length']
+
+
+class CassetteMissError(requests.exceptions.ConnectionError):
+    """No recorded response matches a request in replay mode"""
+
+
+def body_digest(body):
+    if body is None:
+        return None
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    return hashlib.sha1(body).hexdigest() if isinstance(body, bytes) else None
+
+
+def match_keys(method, url, digest):
+    """Keys of a request, from the most to the least specific: with body, without body, without query string.
+    The looser keys match requests whose body or query changes from run to run (multipart boundaries,
+    generated excel files, today's date)."""
+    return [(method, url, digest), (method, url), (method, urlparse(url).path)]
+
+
+class Cassette:
+    """HTTP interactions of a run, recorded to or replayed from a gzipped JSON lines file.
+    In replay mode responses are served in recorded order among requests with the same key,
+    optionally after the recorded latency multiplied by latency_factor."""
+
+    def __init__(self, path, mode, latency_factor=0.):
+        if mode not in ['record', 'replay']:
+            raise ValueError(f"unknown cassette mode {mode}")
+        self.path = path
+        self.mode = mode
+        self.latency_factor = latency_factor
+        self.lock = threading.Lock()
+        if mode == 'record':
+            self.file = gzip.open(path, 'wt', encoding='utf-8')
+        else:
+            self.file = None
+            self.load()
+
+    def load(self):
+        self.interactions = []
+        with gzip.open(self.path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                self.interactions.append(json.loads(line))
+        self.queues = {}
+        for n, interaction in enumerate(self.interactions):
+            for key in match_keys(interaction['method'], interaction['url'], interaction['body']):
+                self.queues.setdefault(key, []).append(n)
+        for queue in self.queues.values():
+            queue.reverse()  # pop from the end
+        self.used = set()
+        self.last = {}
+
+    def record(self, request, response):
+        content = response.content
+        try:
+            text, encoding = content.decode('utf-8'), 'text'
+        except UnicodeDecodeError:
+            text, encoding = base64.b64encode(content).decode('ascii'), 'base64'
+        interaction = {
+            'method': request.method,
+            'url': request.url,
+            'body': body_digest(request.body),
+            'status': response.status_code,
+            'reason': response.reason,
+            'headers': {k: v for k, v in response.headers.items() if k.lower() not in SKIPPED_HEADERS},
+            'content': text,
+            'encoding': encoding,
+            'seconds': response.elapsed.total_seconds(),
+        }
+        line = json.dumps(interaction, ensure_ascii=False) + '\n'
+        with self.lock:
+            self.file.write(line)
+
+    def find(self, request):
+        """Recorded interaction for a request; once all interactions of a URL are replayed, the last one is
+        served again (e.g. for repeated polls of an import status)"""
+        keys = match_keys(request.method, request.url, body_digest(request.body))
+        with self.lock:
+            for key in keys:
+                queue = self.queues.get(key, [])
+                while queue and queue[-1] in self.used:
+                    queue.pop()
+                if queue:
+                    n = queue.pop()
+                    self.used.add(n)
+                    self.last[keys[1]] = n
+                    return self.interactions[n]
+            if keys[1] in self.last:
+                return self.interactions[self.last[keys[1]]]
+        raise CassetteMissError(f"no recorded response for {request.method} {request.url}", request=request)
+
+    def replay(self, request):
+        interaction = self.find(request)
+        if self.latency_factor > 0:
+            time.sleep(interaction['seconds'] * self.latency_factor)
+        response = requests.Response()
+        response.status_code = interaction['status']
+        response.reason = interaction['reason']
+        response.headers = CaseInsensitiveDict(interaction['headers'])
+        if interaction['encoding'] == 'base64':
+            response._content = base64.b64decode(interaction['content'])
+        else:
+            response._content = interaction['content'].encode('utf-8')
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.url = request.url
+        response.request = request
+        response.elapsed = timedelta(seconds=interaction['seconds'])
+        return response
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class CassetteAdapter(BaseAdapter):
+    """Transport adapter that records the responses of another adapter, or replays them without network"""
+
+    def __init__(self, adapter, cassette):
+        super().__init__()
+        self.adapter = adapter
+        self.cassette = cassette
+
+    def send(self, request, **kwargs):
+        if self.cassette.mode == 'replay':
+            return self.cassette.replay(request)
+        response = self.adapter.send(request, **kwargs)
+        self.cassette.record(request, response)
+        return response
+
+    def close(self):
+        self.adapter.close()
@@ -0,0 +1,49 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class BoundedExecutor:
+    """Thread pool whose submit() blocks while too many tasks are in flight,
+    so that a fast producer cannot queue up an unbounded number of records"""
+
+    def __init__(self, max_workers, max_pending=None):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.semaphore = threading.BoundedSemaphore(max_pending or 2 * max_workers)
+        self.lock = threading.Lock()
+        self.exception = None
+
+    def submit(self, fn, *args, **kwargs):
+        self.raise_if_failed()
+        self.semaphore.acquire()
+        try:
+            future = self.executor.submit(fn, *args, **kwargs)
+        except Exception:
+            self.semaphore.release()
+            raise
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        self.semaphore.release()
+        if not future.cancelled() and future.exception() is not None:
+            with self.lock:
+                if self.exception is None:
+                    self.exception = future.exception()
+
+    def raise_if_failed(self):
+        """Re-raise the first exception raised by a task, if any"""
+        if self.exception is not None:
+            raise self.exception
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+        self.raise_if_failed()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.executor.shutdown(wait=True)
+        if exc_type is None:
+            self.raise_if_failed()
+        return False
@@ -1,9 +1,17 @@
-import requests
 import urllib
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pipeline.http_session import create_session
 
 class EspoAPIError(Exception):
     """An exception class for the client"""
 
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
 def http_build_query(data):
     parents = list()
     pairs = dict()
@@ -37,15 +45,35 @@ class EspoAPI:
 
     url_path = '/api/v1/'
 
-    def __init__(self, url, api_key):
+    def __init__(self, url, api_key, session=None, cache=False, cassette=None):
         self.url = url
         self.api_key = api_key
         self.status_code = None
+        self.session = session if session is not None else create_session(cassette=cassette)
+        # collections fetched with request_list_cached, by entity type; None if caching is disabled
+        self.cache = {} if cache else None
+        self.cache_lock = threading.Lock()
 
     def request(self, method, action, params=None):
         if params is None:
             params = {}
 
+        kwargs = self.request_kwargs(method, action, params)
+
+        try:
+            response = self.session.request(method, **kwargs)
+        finally:
+            if method in ['POST', 'PATCH', 'PUT', 'DELETE']:
+                # any write may change cached collections of the entity
+                self.invalidate(params.get('entityType') if action == 'MassAction' else action.split('/')[0])
+
+        self.status_code = response.status_code
+        self.check_response(response)
+
+        return response.json()
+
+    def request_kwargs(self, method, action, params):
+        # URL, headers and body of a request, shared with the async client
         headers = {
         }
 
@@ -60,20 +88,129 @@ class EspoAPI:
             kwargs['json'] = params
         else:
             kwargs['url'] = kwargs['url'] + '?' + http_build_query(params)
+        return kwargs
 
-        response = requests.request(method, **kwargs)
-
-        self.status_code = response.status_code
-
-        if self.status_code != 200:
-            reason = self.parse_reason(response.headers)
-            raise EspoAPIError(f'Wrong request, status code is {response.status_code}, reason is {reason}')
+    @staticmethod
+    def check_response(response):
+        if response.status_code != 200:
+            reason = EspoAPI.parse_reason(response.headers)
+            raise EspoAPIError(f'Wrong request, status code is {response.status_code}, reason is {reason}',
+                               response.status_code)
 
         data = response.content
         if not data:
             raise EspoAPIError('Wrong request, content response is empty')
 
-        return response.json()
+    def request_list(self, action, params=None, max_size=200, prefetch=False):
+        """Iterate over all records of a list request, walking the pages with offset/maxSize.
+        If prefetch is True, the next page is requested while the caller works on the current one."""
+        params = dict(params) if params is not None else {}
+        # a stable order is needed so that pages don't overlap or skip records
+        params.setdefault('orderBy', 'id')
+        params.setdefault('order', 'asc')
+
+        def get_page(offset):
+            return self.request('GET', action, {**params, 'offset': offset, 'maxSize': max_size})['list']
+
+        executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        try:
+            offset = 0
+            page = get_page(offset)
+            while page:
+                next_page = None
+                if executor is not None and len(page) == max_size:
+                    next_page = executor.submit(get_page, offset + max_size)
+                yield from page
+                if len(page) < max_size:
+                    break
+                offset += max_size
+                page = next_page.result() if next_page is not None else get_page(offset)
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False)
+
+    def request_list_cached(self, action, params=None, max_size=200):
+        """Like request_list, but returns a list which is reused by later calls with the same arguments
+        until the entity is written to or the cache is invalidated. Records must not be modified."""
+        if self.cache is None:
+            return list(self.request_list(action, params, max_size, prefetch=True))
+        entity_type = action.split('/')[0]
+        key = (action, json.dumps(params, sort_keys=True), max_size)
+        with self.cache_lock:
+            if key in self.cache.get(entity_type, {}):
+                return self.cache[entity_type][key]
+        records = list(self.request_list(action, params, max_size, prefetch=True))
+        with self.cache_lock:
+            self.cache.setdefault(entity_type, {})[key] = records
+        return records
+
+    def invalidate(self, entity_type=None):
+        """Drop the cached collections of an entity type, or all of them"""
+        if self.cache is None:
+            return
+        with self.cache_lock:
+            if entity_type is None:
+                self.cache.clear()
+            else:
+                self.cache.pop(entity_type, None)
+
+    def mass_update(self, entity_type, ids, data, batch_size=200):
+        """Apply the same changes to many records with EspoCRM mass updates of up to batch_size records.
+        If a mass update fails, its records are updated one by one, skipping those that no longer exist."""
+        ids = list(ids)
+        for i in range(0, len(ids), batch_size):
+            batch_ids = ids[i:i + batch_size]
+            if len(batch_ids) > 1:
+                try:
+                    result = self.request('POST', 'MassAction', self.mass_action_params(entity_type, batch_ids, data))
+                    if self.mass_update_done(entity_type, batch_ids, result):
+                        continue
+                except EspoAPIError as e:
+                    logging.warning(f'mass update of {entity_type} failed ({e}), updating records one by one')
+            for id_ in batch_ids:
+                try:
+                    self.request('PUT', f'{entity_type}/{id_}', data)
+                except EspoAPIError as e:
+                    self.skip_missing(e, entity_type, id_)
+
+    # steps of mass updates, shared with the async client
+    @staticmethod
+    def mass_action_params(entity_type, ids, data):
+        return {
+            'entityType': entity_type,
+            'action': 'update',
+            'params': {'ids': ids},
+            'data': data
+        }
+
+    @staticmethod
+    def mass_update_done(entity_type, ids, result):
+        """True if a mass update updated all its records"""
+        if result.get('count') == len(ids):
+            return True
+        logging.warning(f'mass update of {entity_type} updated {result.get("count")} records '
+                        f'out of {len(ids)}, updating them one by one')
+        return False
+
+    @staticmethod
+    def skip_missing(error, entity_type, id_):
+        # records deleted since they were listed are skipped, other errors are raised
+        if error.status_code != 404:
+            raise error
+        logging.warning(f'{entity_type} {id_} not found, not updated')
+
+    def batch_update(self, entity_type, updates, batch_size=200):
+        """Apply a list of (id, data) updates, grouping records with identical changes in mass updates"""
+        for data, ids in self.update_groups(updates):
+            self.mass_update(entity_type, ids, data, batch_size)
+
+    @staticmethod
+    def update_groups(updates):
+        """(data, ids) of the records of (id, data) updates with identical changes"""
+        groups = {}
+        for id_, data in updates:
+            groups.setdefault(json.dumps(data, sort_keys=True), (data, []))[1].append(id_)
+        return list(groups.values())
 
     def normalize_url(self, action):
         return self.url + self.url_path + action
@@ -0,0 +1,41 @@
+import io
+from pipeline.values import is_missing
+
+
+def cell_value(value):
+    # empty cells for missing values and text for other objects, as pandas.DataFrame.to_excel does
+    if is_missing(value):
+        return None
+    if isinstance(value, (dict, list)):
+        return str(value)
+    return value
+
+
+def write_rows(worksheet, rows, start_row=0):
+    """Write rows one after the other, returns the number of rows written.
+    In constant_memory mode, each row is flushed to disk once the next one is started."""
+    nrows = 0
+    for nrow, row in enumerate(rows, start=start_row):
+        for ncol, value in enumerate(row):
+            value = cell_value(value)
+            if value is not None:
+                worksheet.write(nrow, ncol, value)
+        nrows += 1
+    return nrows
+
+
+def write_workbook(columns, rows, sheet_name='Sheet1', title_row=None):
+    """Write a single-sheet excel workbook (header and rows) in memory and return its content as bytes.
+    If title_row is given, it is written above the header."""
+    import xlsxwriter
+    buffer = io.BytesIO()
+    workbook = xlsxwriter.Workbook(buffer, {'in_memory': True})
+    worksheet = workbook.add_worksheet(sheet_name)
+    header_row = 0
+    if title_row is not None:
+        worksheet.write_row(0, 0, list(title_row))
+        header_row = 1
+    worksheet.write_row(header_row, 0, list(columns))
+    write_rows(worksheet, rows, header_row + 1)
+    workbook.close()
+    return buffer.getvalue()
@@ -0,0 +1,129 @@
+import logging
+import random
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from pipeline.cassette import CassetteAdapter
+from pipeline.limiter import retry_after_seconds
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_BACKOFF_FACTOR = 0.5
+DEFAULT_TIMEOUT = (10, 120)  # (connect, read) in seconds
+
+
+class JitteredRetry(Retry):
+    """Retry policy that adds random jitter to the exponential backoff"""
+
+    def get_backoff_time(self):
+        backoff = super().get_backoff_time()
+        if backoff <= 0:
+            return backoff
+        return random.uniform(0, backoff)
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """HTTP adapter that applies a default timeout to every request"""
+
+    def __init__(self, *args, timeout=DEFAULT_TIMEOUT, **kwargs):
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super().send(request, **kwargs)
+
+
+def body_size(body):
+    if body is None:
+        return 0
+    if isinstance(body, str):
+        return len(body.encode('utf-8'))
+    if isinstance(body, bytes):
+        return len(body)
+    return 0
+
+
+class PipelineSession(requests.Session):
+    """Session that reports the latency, status and size of every request to a Metrics object, if set,
+    waits for a slot of a RequestLimiter, if set, and sends again requests rejected with 429 Too Many Requests
+    (which the backend did not process, so this is safe for all methods)"""
+
+    metrics = None
+    limiter = None
+    max_throttle_retries = DEFAULT_MAX_RETRIES
+    backoff_factor = DEFAULT_BACKOFF_FACTOR
+
+    def request(self, method, url, *args, **kwargs):
+        for attempt in range(self.max_throttle_retries + 1):
+            response = self.limited_request(method, url, *args, **kwargs)
+            if response.status_code != 429 or attempt == self.max_throttle_retries:
+                return response
+            delay = retry_after_seconds(response.headers.get('Retry-After'))
+            if delay is None:
+                delay = self.backoff_factor * 2 ** attempt
+            logging.warning(f"{method} {url}: too many requests, retrying in {delay:.1f} s")
+            response.close()
+            time.sleep(delay)
+
+    def limited_request(self, method, url, *args, **kwargs):
+        if self.limiter is None:
+            return self.measured_request(method, url, *args, **kwargs)
+        with self.limiter.slot(method, url) as slot:
+            slot['response'] = self.measured_request(method, url, *args, **kwargs)
+            return slot['response']
+
+    def measured_request(self, method, url, *args, **kwargs):
+        if self.metrics is None:
+            return super().request(method, url, *args, **kwargs)
+        start = time.monotonic()
+        try:
+            response = super().request(method, url, *args, **kwargs)
+        except Exception:
+            self.metrics.record_request(method, url, None, time.monotonic() - start)
+            raise
+        if 'Content-Length' in response.headers:
+            bytes_received = int(response.headers['Content-Length'])
+        elif not kwargs.get('stream'):
+            bytes_received = len(response.content)
+        else:
+            bytes_received = 0
+        self.metrics.record_request(method, url, response.status_code, time.monotonic() - start,
+                                    body_size(response.request.body), bytes_received)
+        return response
+
+
+def create_session(pool_size=DEFAULT_POOL_SIZE, max_retries=DEFAULT_MAX_RETRIES,
+                   backoff_factor=DEFAULT_BACKOFF_FACTOR, timeout=DEFAULT_TIMEOUT, keep_alive=True, metrics=None,
+                   cassette=None, limiter=None):
+    """Create a session with a keep-alive connection pool, default timeouts and retries with jittered backoff.
+    Connection errors are retried for all methods, 5xx responses only for idempotent methods,
+    so that e.g. a beneficiary import is never sent twice.
+    With a cassette, responses are recorded to it or replayed from it (then without network).
+    With a limiter, concurrent requests are adapted to what each backend sustains."""
+    retry = JitteredRetry(
+        total=max_retries,
+        connect=max_retries,
+        read=max_retries,
+        status=max_retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=[500, 502, 503, 504],
+        allowed_methods=frozenset(['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS']),
+        raise_on_status=False
+    )
+    adapter = TimeoutHTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry,
+                                 timeout=timeout)
+    if cassette is not None:
+        adapter = CassetteAdapter(adapter, cassette)
+    session = PipelineSession()
+    session.metrics = metrics
+    session.limiter = limiter
+    session.max_throttle_retries = max_retries
+    session.backoff_factor = backoff_factor
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    if not keep_alive:
+        session.headers['Connection'] = 'close'
+    return session
@@ -0,0 +1,72 @@
+import json
+import logging
+import os
+import threading
+
+DEFAULT_JOURNAL_PATH = '../data/journal.jsonl'
+
+
+class Journal:
+    """Append-only log of the units of work completed by a run (one JSON record per line), so that a run
+    interrupted by a failure can be resumed without redoing them. The records of a step are cleared once
+    the step completes."""
+
+    def __init__(self, path=DEFAULT_JOURNAL_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.records = []
+        complete = self.load()
+        if self.records:
+            logging.info(f"resuming from {len(self.records)} records of an interrupted run in {path}")
+        if not complete:
+            self.write()
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def load(self):
+        """Read the records of the journal, return False if a record is incomplete"""
+        complete = True
+        if not os.path.exists(self.path):
+            return complete
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    self.records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # last line cut short by the interruption
+                    logging.warning(f"skipping incomplete journal record {line.strip()}")
+                    complete = False
+        return complete
+
+    def write(self):
+        # replace the journal with the records in memory
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for record in self.records:
+                f.write(json.dumps(record) + '\n')
+        os.replace(tmp_path, self.path)
+
+    def append(self, step, unit, **data):
+        """Record a completed unit of work of a step"""
+        record = {'step': step, 'unit': unit, **data}
+        line = json.dumps(record) + '\n'
+        with self.lock:
+            # flushed at once, so that the record survives if the process is killed
+            self.file.write(line)
+            self.file.flush()
+            self.records.append(record)
+
+    def find(self, step, unit):
+        with self.lock:
+            return [r for r in self.records if r['step'] == step and r['unit'] == unit]
+
+    def clear(self, step):
+        """Remove the records of a completed step"""
+        with self.lock:
+            self.records = [r for r in self.records if r['step'] != step]
+            self.file.close()
+            self.write()
+            self.file = open(self.path, 'a', encoding='utf-8')
+
+    def close(self):
+        with self.lock:
+            self.file.close()
@@ -0,0 +1,183 @@
+import asyncio
+import logging
+import threading
+import time
+from contextlib import contextmanager, asynccontextmanager
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+# initial and maximum number of concurrent requests of each budget
+DEFAULT_LIMITS = {'read': 8, 'write': 8, 'import': 2}
+DEFAULT_MAX_LIMIT = 64
+# requests of each budget slower than this (in seconds) are a sign of an overloaded backend
+DEFAULT_LATENCY_TARGETS = {'read': 5., 'write': 5., 'import': 30.}
+# statuses by which a backend asks to slow down
+THROTTLE_STATUSES = [429, 503]
+
+
+def endpoint_class(method, path):
+    """Budget of an endpoint: 'read' for GET requests (including import status polls), 'import' for excel
+    and beneficiary imports (slow and heavy on RedRose) and 'write' for the rest"""
+    if method.upper() in ['GET', 'HEAD', 'OPTIONS']:
+        return 'read'
+    if 'import' in path.lower() or 'upload' in path.lower():
+        return 'import'
+    return 'write'
+
+
+def retry_after_seconds(value):
+    """Delay of a Retry-After header (seconds or HTTP date), None if missing or invalid"""
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.)
+    except (TypeError, ValueError):
+        return None
+
+
+class AIMDLimit:
+    """Limit on the concurrent requests of one budget, adapted to the backend: additive increase
+    (by one request per limit successful requests), multiplicative decrease on throttling or slow responses"""
+
+    def __init__(self, name, initial, maximum=DEFAULT_MAX_LIMIT, minimum=1, latency_target=5., decrease_factor=0.5):
+        self.name = name
+        self.limit = float(initial)
+        self.maximum = maximum
+        self.minimum = minimum
+        self.latency_target = latency_target
+        self.decrease_factor = decrease_factor
+        self.in_flight = 0
+        self.blocked_until = 0.
+        self.last_decrease = 0.
+        self.condition = threading.Condition()
+
+    def try_acquire(self):
+        """Take a slot if one is free (returns True), else return the seconds to wait (None: until a release).
+        Called with the condition held."""
+        wait = self.blocked_until - time.monotonic()
+        if wait <= 0 and self.in_flight < int(self.limit):
+            self.in_flight += 1
+            return True
+        return wait if wait > 0 else None
+
+    def acquire(self):
+        with self.condition:
+            while True:
+                wait = self.try_acquire()
+                if wait is True:
+                    return
+                self.condition.wait(wait)
+
+    def update(self, seconds, status_code, retry_after=None):
+        """Free the slot of a finished request and adapt the limit. Called with the condition held."""
+        self.in_flight -= 1
+        now = time.monotonic()
+        if status_code in THROTTLE_STATUSES:
+            if retry_after is not None:
+                self.blocked_until = max(self.blocked_until, now + retry_after)
+            self.decrease(now, f'status {status_code}')
+        elif seconds > self.latency_target:
+            self.decrease(now, f'{seconds:.1f} s response')
+        elif status_code is not None and status_code < 500 and self.in_flight + 1 >= int(self.limit):
+            # increase only when the limit is actually reached
+            self.limit = min(self.limit + 1. / self.limit, self.maximum)
+
+    def release(self, seconds, status_code, retry_after=None):
+        with self.condition:
+            self.update(seconds, status_code, retry_after)
+            self.condition.notify_all()
+
+    def decrease(self, now, reason):
+        # at most one decrease per latency target, as the requests in flight all see the same overload
+        if now - self.last_decrease < self.latency_target:
+            return
+        self.last_decrease = now
+        limit = max(self.limit * self.decrease_factor, self.minimum)
+        if int(limit) < int(self.limit):
+            logging.info(f"{self.name}: {reason}, lowering concurrent requests to {int(limit)}")
+        self.limit = limit
+
+
+class AsyncAIMDLimit(AIMDLimit):
+    """AIMDLimit for the coroutines of one event loop"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self.condition:
+            while True:
+                wait = self.try_acquire()
+                if wait is True:
+                    return
+                try:
+                    await asyncio.wait_for(self.condition.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def release(self, seconds, status_code, retry_after=None):
+        async with self.condition:
+            self.update(seconds, status_code, retry_after)
+            self.condition.notify_all()
+
+
+class RequestLimiter:
+    """Adaptive limits on concurrent requests, with one budget per host and endpoint class"""
+
+    limit_class = AIMDLimit
+
+    def __init__(self, limits=None, maximum=DEFAULT_MAX_LIMIT, latency_targets=None):
+        self.limits = dict(DEFAULT_LIMITS, **(limits or {}))
+        self.maximum = maximum
+        self.latency_targets = dict(DEFAULT_LATENCY_TARGETS, **(latency_targets or {}))
+        self.budgets = {}
+        self.lock = threading.Lock()
+
+    def budget(self, method, url):
+        key = (urlparse(url).netloc, endpoint_class(method, urlparse(url).path))
+        with self.lock:
+            if key not in self.budgets:
+                self.budgets[key] = self.limit_class(f'{key[0]} {key[1]}', self.limits[key[1]], self.maximum,
+                                                     latency_target=self.latency_targets[key[1]])
+            return self.budgets[key]
+
+    @contextmanager
+    def slot(self, method, url):
+        """Wait for a free slot in the budget of a request; the caller reports the outcome in slot['response']"""
+        budget = self.budget(method, url)
+        budget.acquire()
+        slot = {'response': None}
+        start = time.monotonic()
+        try:
+            yield slot
+        finally:
+            response = slot['response']
+            status_code = response.status_code if response is not None else None
+            retry_after = retry_after_seconds(response.headers.get('Retry-After')) if response is not None else None
+            budget.release(time.monotonic() - start, status_code, retry_after)
+
+
+class AsyncRequestLimiter(RequestLimiter):
+    """RequestLimiter for an async session, used from one event loop"""
+
+    limit_class = AsyncAIMDLimit
+
+    @asynccontextmanager
+    async def slot(self, method, url):
+        """Wait for a free slot in the budget of a request; the caller reports the outcome in slot['response']"""
+        budget = self.budget(method, url)
+        await budget.acquire()
+        slot = {'response': None}
+        start = time.monotonic()
+        try:
+            yield slot
+        finally:
+            response = slot['response']
+            status_code = response.status_code if response is not None else None
+            retry_after = retry_after_seconds(response.headers.get('Retry-After')) if response is not None else None
+            await budget.release(time.monotonic() - start, status_code, retry_after)
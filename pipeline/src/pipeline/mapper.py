@@ -0,0 +1,67 @@
+import csv
+import logging
+from functools import lru_cache
+
+
+def read_mapping(path):
+    """Rows of the mapping file (action, redrose.field, espo.entity, espo.field) as dicts"""
+    with open(path, newline='', encoding='utf-8') as f:
+        return list(csv.DictReader(f))
+
+
+@lru_cache(maxsize=65536)
+def transliterate(value):
+    # values such as oblast and bank names repeat across records, transliterate them once
+    from unidecode import unidecode
+    return unidecode(value)
+
+
+class FieldMapper:
+    """Mapping of EspoCRM fields to RedRose fields, compiled once per entity"""
+
+    def __init__(self, fields, fixed_values=None):
+        self.fields = list(fields)  # list of (espo field, redrose field)
+        self.fixed_values = dict(fixed_values) if fixed_values is not None else {}
+        self.validated = False
+
+    @classmethod
+    def from_rows(cls, rows, fixed_values=None):
+        return cls([(row['espo.field'], row['redrose.field']) for row in rows], fixed_values)
+
+    def validate(self, entity):
+        """Check once which mapped fields are missing in EspoCRM, log them and drop them from the mapping"""
+        missing = [espo_field for espo_field, _ in self.fields if espo_field not in entity.keys()]
+        for espo_field in dict.fromkeys(missing):
+            logging.error(f"ERROR: field {espo_field} not found in EspoCRM !!!")
+        self.fields = [(espo_field, rr_field) for espo_field, rr_field in self.fields if espo_field in entity.keys()]
+        self.validated = True
+
+    def map(self, entity):
+        """Map one EspoCRM record to a RedRose payload"""
+        if not self.validated:
+            self.validate(entity)
+        payload = {rr_field: transliterate(str(entity[espo_field])) for espo_field, rr_field in self.fields}
+        payload.update(self.fixed_values)
+        return payload
+
+    def map_batch(self, entities):
+        """Map a page of EspoCRM records at once, with vectorized pandas string operations"""
+        import pandas as pd
+        if not entities:
+            return []
+        if not self.validated:
+            self.validate(entities[0])
+        if not self.fields:
+            return [dict(self.fixed_values) for _ in entities]
+        espo_fields = list(dict.fromkeys(espo_field for espo_field, _ in self.fields))
+        # object dtype keeps the original python values, and map(str) gives the same strings as str() in map()
+        df = pd.DataFrame(entities, columns=espo_fields, dtype=object)
+        columns = {}
+        for espo_field in espo_fields:
+            values = df[espo_field].map(str)
+            columns[espo_field] = values.map({value: transliterate(value) for value in values.unique()})
+        payloads = pd.DataFrame({rr_field: columns[espo_field] for espo_field, rr_field in self.fields})
+        payloads = payloads.to_dict('records')
+        for payload in payloads:
+            payload.update(self.fixed_values)
+        return payloads
@@ -0,0 +1,224 @@
+import json
+import os
+import click
+import re
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+# upper bounds of the request latency histogram, in seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30., 60., float('inf'))
+METRIC_PREFIX = 'espo2redrose'
+
+
+def client_name(path):
+    if path.startswith('/api/v1/'):
+        return 'espo'
+    if path.startswith('/externalapi/'):
+        return 'redrose'
+    return 'redrose_payments'
+
+
+def endpoint_name(path):
+    """Path of a request with record ids replaced by {id}, so that requests can be grouped by endpoint"""
+    segments = []
+    for segment in path.split('/'):
+        if re.fullmatch(r'[0-9a-fA-F-]{16,}|\d+', segment):
+            segment = '{id}'
+        segments.append(segment)
+    return '/'.join(segments)
+
+
+def labels(**kwargs):
+    return '{' + ','.join(f'{key}="{value}"' for key, value in kwargs.items()) + '}'
+
+
+def new_endpoint():
+    return {
+        'requests': 0, 'errors': 0, 'status_codes': {}, 'seconds': 0.,
+        'latency_buckets': [0] * len(LATENCY_BUCKETS), 'bytes_sent': 0, 'bytes_received': 0
+    }
+
+
+class Metrics:
+    """Wall time of the pipeline steps and statistics of the HTTP requests of a run,
+    exported as a JSON report or in Prometheus textfile format.
+    With accumulate_steps (long-running processes), the records and seconds of steps that run several times
+    are summed instead of keeping only the last run."""
+
+    def __init__(self, accumulate_steps=False):
+        self.accumulate_steps = accumulate_steps
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.finished_at = None
+        self.success = None
+        self.steps = {}
+        self.endpoints = {}
+
+    @contextmanager
+    def step(self, name):
+        """Time a step; the caller can count the records it processed in step['records']"""
+        step = {'records': 0}
+        start = time.monotonic()
+        try:
+            yield step
+        finally:
+            seconds = time.monotonic() - start
+            with self.lock:
+                if self.accumulate_steps and name in self.steps:
+                    total = self.steps[name]
+                    total['records'] += step['records']
+                    total['seconds'] += seconds
+                else:
+                    total = self.steps[name] = {'records': step['records'], 'seconds': seconds}
+                total['records_per_second'] = total['records'] / total['seconds'] if total['seconds'] > 0 else 0.
+
+    def record_request(self, method, url, status_code, seconds, bytes_sent=0, bytes_received=0):
+        """Record an HTTP request; status_code is None if no response was received"""
+        path = urlparse(url).path
+        key = (client_name(path), method, endpoint_name(path))
+        error = status_code is None or status_code >= 400
+        with self.lock:
+            endpoint = self.endpoints.setdefault(key, new_endpoint())
+            endpoint['requests'] += 1
+            endpoint['errors'] += int(error)
+            status = str(status_code) if status_code is not None else 'error'
+            endpoint['status_codes'][status] = endpoint['status_codes'].get(status, 0) + 1
+            endpoint['seconds'] += seconds
+            for nbucket, upper_bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= upper_bound:
+                    endpoint['latency_buckets'][nbucket] += 1
+                    break
+            endpoint['bytes_sent'] += bytes_sent
+            endpoint['bytes_received'] += bytes_received
+
+    def merge(self, report):
+        """Add the report (as in to_dict) of a run that ran in parallel, e.g. another shard: records and requests
+        are summed, the wall time of a step is the longest one"""
+        with self.lock:
+            self.started_at = min(self.started_at, report['started_at'])
+            for name, step in report['steps'].items():
+                merged = self.steps.setdefault(name, {'records': 0, 'seconds': 0.})
+                merged['records'] += step['records']
+                merged['seconds'] = max(merged['seconds'], step['seconds'])
+                merged['records_per_second'] = merged['records'] / merged['seconds'] if merged['seconds'] > 0 else 0.
+            for e in report['http']:
+                endpoint = self.endpoints.setdefault((e['client'], e['method'], e['endpoint']), new_endpoint())
+                for field in ['requests', 'errors', 'seconds', 'bytes_sent', 'bytes_received']:
+                    endpoint[field] += e[field]
+                for status, count in e['status_codes'].items():
+                    endpoint['status_codes'][status] = endpoint['status_codes'].get(status, 0) + count
+                endpoint['latency_buckets'] = [a + b for a, b in zip(endpoint['latency_buckets'],
+                                                                     e['latency_buckets'])]
+
+    def finish(self, success):
+        self.finished_at = time.time()
+        self.success = success
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'started_at': self.started_at,
+                'finished_at': self.finished_at,
+                'seconds': (self.finished_at or time.time()) - self.started_at,
+                'success': self.success,
+                'steps': {name: dict(step) for name, step in self.steps.items()},
+                'http': [
+                    {'client': client, 'method': method, 'endpoint': endpoint,
+                     **{k: (dict(v) if isinstance(v, dict) else v) for k, v in stats.items()},
+                     'latency_bucket_bounds': [str(b) for b in LATENCY_BUCKETS]}
+                    for (client, method, endpoint), stats in self.endpoints.items()
+                ]
+            }
+
+    def write_json(self, path):
+        write_atomic(path, json.dumps(self.to_dict(), indent=2))
+
+    def to_prometheus(self):
+        report = self.to_dict()
+        lines = []
+
+        def metric(name, kind, help_, samples):
+            lines.append(f'# HELP {METRIC_PREFIX}_{name} {help_}')
+            lines.append(f'# TYPE {METRIC_PREFIX}_{name} {kind}')
+            for sample_labels, value in samples:
+                lines.append(f'{METRIC_PREFIX}_{name}{sample_labels} {value}')
+
+        metric('run_timestamp_seconds', 'gauge', 'Start time of the run.',
+               [('', report['started_at'])])
+        metric('run_duration_seconds', 'gauge', 'Wall time of the run.',
+               [('', report['seconds'])])
+        metric('run_success', 'gauge', 'Whether the run completed without errors.',
+               [('', int(bool(report['success'])))])
+        steps = report['steps'].items()
+        metric('step_duration_seconds', 'gauge', 'Wall time of a pipeline step.',
+               [(labels(step=name), step['seconds']) for name, step in steps])
+        metric('step_records', 'gauge', 'Records processed by a pipeline step.',
+               [(labels(step=name), step['records']) for name, step in steps])
+        metric('step_records_per_second', 'gauge', 'Records processed per second by a pipeline step.',
+               [(labels(step=name), step['records_per_second']) for name, step in steps])
+
+        http = report['http']
+        metric('http_requests_total', 'counter', 'HTTP requests by endpoint and status code.',
+               [(labels(client=e['client'], method=e['method'], endpoint=e['endpoint'], status=status), count)
+                for e in http for status, count in e['status_codes'].items()])
+        metric('http_errors_total', 'counter', 'HTTP requests that failed or returned an error status.',
+               [(labels(client=e['client'], method=e['method'], endpoint=e['endpoint']), e['errors'])
+                for e in http])
+        metric('http_bytes_sent_total', 'counter', 'Bytes sent in HTTP request bodies.',
+               [(labels(client=e['client'], method=e['method'], endpoint=e['endpoint']), e['bytes_sent'])
+                for e in http])
+        metric('http_bytes_received_total', 'counter', 'Bytes received in HTTP response bodies.',
+               [(labels(client=e['client'], method=e['method'], endpoint=e['endpoint']), e['bytes_received'])
+                for e in http])
+        name = f'{METRIC_PREFIX}_http_request_duration_seconds'
+        lines.append(f'# HELP {name} Latency of HTTP requests.')
+        lines.append(f'# TYPE {name} histogram')
+        for e in http:
+            endpoint_labels = dict(client=e['client'], method=e['method'], endpoint=e['endpoint'])
+            cumulative = 0
+            for upper_bound, count in zip(LATENCY_BUCKETS, e['latency_buckets']):
+                cumulative += count
+                le = '+Inf' if upper_bound == float('inf') else str(upper_bound)
+                lines.append(f'{name}_bucket{labels(**endpoint_labels, le=le)} {cumulative}')
+            lines.append(f'{name}_sum{labels(**endpoint_labels)} {e["seconds"]}')
+            lines.append(f'{name}_count{labels(**endpoint_labels)} {e["requests"]}')
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        write_atomic(path, self.to_prometheus())
+
+
+def write_atomic(path, text):
+    # write to a temporary file first, so that collectors never read a partial file
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+@click.command()
+@click.argument('reports', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option('--metrics-json', type=click.Path(dir_okay=False), default=None,
+              help="Write the merged JSON report to this file.")
+@click.option('--metrics-prom', type=click.Path(dir_okay=False), default=None,
+              help="Write the merged metrics to this file in Prometheus textfile format.")
+def merge_reports(reports, metrics_json, metrics_prom):
+    """Merge the JSON reports of the shards of a run (e.g. one per container replica) into one report"""
+    metrics = Metrics()
+    finished_at, success = None, True
+    for path in reports:
+        with open(path) as f:
+            report = json.load(f)
+        metrics.merge(report)
+        finished_at = max(finished_at or 0., report['finished_at'] or 0.)
+        success = success and bool(report['success'])
+    metrics.finish(success)
+    metrics.finished_at = finished_at or metrics.finished_at
+    if metrics_json is not None:
+        metrics.write_json(metrics_json)
+    if metrics_prom is not None:
+        metrics.write_prometheus(metrics_prom)
+    if metrics_json is None and metrics_prom is None:
+        click.echo(json.dumps(metrics.to_dict(), indent=2))
@@ -2,19 +2,32 @@
 """
 Connector between EspoCRM and RedRose
 """
-import pandas as pd
 from pipeline.espo_api_client import EspoAPI
-from pipeline.redrose_api_client import RedRoseAPI, RedRosePaymentsAPI, RedRoseAPIError
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail, To, Attachment, FileContent, FileName, FileType, Disposition
-import base64
+from pipeline.redrose_api_client import RedRoseAPI, RedRosePaymentsAPI, ExcelImportPoller
+from pipeline.http_session import create_session
+from pipeline.limiter import RequestLimiter
+from pipeline.beneficiaries import sync_beneficiaries, sync_beneficiaries_bulk, sync_beneficiaries_async, \
+    modified_since_params
+from pipeline.state_store import StateStore, DEFAULT_STATE_PATH
+from pipeline.reconciliation import reconcile_payments, fetch_transactions, open_payments_params, \
+    reconcile_payments_async, fetch_transactions_async, RECONCILIATION_FIELDS
+from pipeline.mapper import read_mapping
+from pipeline.journal import Journal, DEFAULT_JOURNAL_PATH
+from pipeline.sharding import parse_shard, sub_shards, shard_key
+from pipeline.server import ChangeQueue, WebhookServer, Schedule, ids_params, WEBHOOK_BATCH_SIZE
+from pipeline.metrics import Metrics
+from pipeline.cassette import Cassette
 import os
 import sys
-import json
-from unidecode import unidecode
+import shutil
+import tempfile
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from dotenv import load_dotenv
 import click
-from datetime import datetime
+from datetime import datetime, timedelta
+from contextlib import closing, asynccontextmanager
 import logging
 
 logger = logging.getLogger()
@@ -30,40 +43,332 @@ logging.getLogger("azure").setLevel(logging.WARNING)
 logging.getLogger("requests_oauthlib").setLevel(logging.WARNING)
 
 load_dotenv(dotenv_path="../credentials/.env")
-MAX_NUMBER_PAYMENTS = 500
 
 
-def update_redrose_id(rr_data, entity_name, entity, espo_client):
-    if 'm' in rr_data.keys():
-        if 'id' in rr_data['m'].keys():
-            espo_client.request('PUT', f"{entity_name}/{entity['id']}",
-                                {"redroseInternalID": f"{rr_data['m']['id']}"})
-
-
-def make_hyperlink(espo_url, value):
-    url = f"{espo_url}/#Shelter/view/"+"{}"
-    linkname = "Link to profile"
-    return '=HYPERLINK("%s", "%s")' % (url.format(value), linkname)
+def setup_limiter(limiter_class=RequestLimiter):
+    # adaptive limits on concurrent requests, per host and endpoint class
+    if os.getenv("HTTP_ADAPTIVE_LIMIT", "true").lower() != "true":
+        return None
+    return limiter_class(limits={'read': int(os.getenv("HTTP_LIMIT_READ", 8)),
+                                 'write': int(os.getenv("HTTP_LIMIT_WRITE", 8)),
+                                 'import': int(os.getenv("HTTP_LIMIT_IMPORT", 2))},
+                         maximum=int(os.getenv("HTTP_LIMIT_MAX", 64)),
+                         latency_targets={'read': float(os.getenv("HTTP_LATENCY_TARGET", 5)),
+                                          'write': float(os.getenv("HTTP_LATENCY_TARGET", 5)),
+                                          'import': float(os.getenv("HTTP_IMPORT_LATENCY_TARGET", 30))})
+
+
+def setup_clients(workers=1, metrics=None, cassette=None):
+    # one pool of keep-alive connections, shared by all clients
+    session = create_session(pool_size=max(int(os.getenv("HTTP_POOL_SIZE", 10)), 2 * workers),
+                             max_retries=int(os.getenv("HTTP_MAX_RETRIES", 3)),
+                             backoff_factor=float(os.getenv("HTTP_BACKOFF_FACTOR", 0.5)),
+                             timeout=(float(os.getenv("HTTP_CONNECT_TIMEOUT", 10)),
+                                      float(os.getenv("HTTP_READ_TIMEOUT", 120))),
+                             keep_alive=os.getenv("HTTP_KEEP_ALIVE", "true").lower() == "true",
+                             metrics=metrics,
+                             cassette=cassette,
+                             limiter=setup_limiter())
+    espo_client = EspoAPI(os.getenv("ESPOURL"), os.getenv("ESPOAPIKEY"), session=session, cache=True)
+    redrose_client = RedRoseAPI(os.getenv("RRURL"), os.getenv("RRAPIUSER"), os.getenv("RRAPIKEY"),
+                                os.getenv("RRMODULE"), session=session)
+    redrose_pay_client = RedRosePaymentsAPI(host_name=os.getenv("RRURL").replace("https://", ""),
+                                            user_name=os.getenv("RRAPIUSER"),
+                                            password=os.getenv("RRAPIKEY"),
+                                            session=session)
+    poller = ExcelImportPoller(redrose_pay_client, **poller_options())
+    return espo_client, redrose_client, redrose_pay_client, poller
+
+
+def poller_options():
+    return dict(initial_delay=float(os.getenv("IMPORT_POLL_INITIAL_DELAY", 1)),
+                max_delay=float(os.getenv("IMPORT_POLL_MAX_DELAY", 60)),
+                deadline=float(os.getenv("IMPORT_POLL_DEADLINE", 1800)),
+                max_polls=int(os.getenv("IMPORT_POLL_MAX_POLLS", 200)))
+
+
+@asynccontextmanager
+async def setup_async_clients(metrics, concurrency):
+    """Async counterparts of the clients of setup_clients, sharing one pool of up to concurrency connections"""
+    # aiohttp is only needed in async mode
+    from pipeline.async_clients import AsyncPipelineSession, AsyncEspoAPI, AsyncRedRoseAPI, \
+        AsyncRedRosePaymentsAPI, AsyncExcelImportPoller
+    from pipeline.limiter import AsyncRequestLimiter
+    async with AsyncPipelineSession(pool_size=concurrency,
+                                    max_retries=int(os.getenv("HTTP_MAX_RETRIES", 3)),
+                                    backoff_factor=float(os.getenv("HTTP_BACKOFF_FACTOR", 0.5)),
+                                    timeout=(float(os.getenv("HTTP_CONNECT_TIMEOUT", 10)),
+                                             float(os.getenv("HTTP_READ_TIMEOUT", 120))),
+                                    keep_alive=os.getenv("HTTP_KEEP_ALIVE", "true").lower() == "true",
+                                    metrics=metrics,
+                                    limiter=setup_limiter(AsyncRequestLimiter)) as session:
+        espo_client = AsyncEspoAPI(os.getenv("ESPOURL"), os.getenv("ESPOAPIKEY"), session)
+        redrose_client = AsyncRedRoseAPI(os.getenv("RRURL"), os.getenv("RRAPIUSER"), os.getenv("RRAPIKEY"),
+                                         os.getenv("RRMODULE"), session)
+        redrose_pay_client = AsyncRedRosePaymentsAPI(host_name=os.getenv("RRURL").replace("https://", ""),
+                                                     user_name=os.getenv("RRAPIUSER"),
+                                                     password=os.getenv("RRAPIKEY"),
+                                                     session=session)
+        poller = AsyncExcelImportPoller(redrose_pay_client, **poller_options())
+        yield espo_client, redrose_client, redrose_pay_client, poller
+
+
+async def sync_entity_async(entity_name, mapping_, metrics, concurrency, **kwargs):
+    """Sync the beneficiaries of an entity with async clients"""
+    async with setup_async_clients(metrics, concurrency) as (espo_client, redrose_client, _, _):
+        return await sync_beneficiaries_async(entity_name, mapping_, espo_client, redrose_client,
+                                              concurrency=concurrency, **kwargs)
+
+
+async def create_topups_with_async_clients(df_espo_pay, metrics, concurrency, **kwargs):
+    """Create the top-up requests of the payments with async clients"""
+    from pipeline.topup import create_topups_async
+    async with setup_async_clients(metrics, concurrency) as (espo_client, _, redrose_pay_client, poller):
+        return await create_topups_async(df_espo_pay, espo_client, redrose_pay_client, poller, metrics=metrics,
+                                         **kwargs)
+
+
+async def fetch_transactions_with_async_clients(espo_payments, metrics, concurrency, **kwargs):
+    """Fetch the transactions that can match the payments with async clients"""
+    async with setup_async_clients(metrics, concurrency) as (_, redrose_client, _, _):
+        return await fetch_transactions_async(redrose_client, espo_payments, **kwargs)
+
+
+async def reconcile_with_async_clients(espo_payments, transactions, metrics, concurrency):
+    """Update the status of the payments with async clients"""
+    async with setup_async_clients(metrics, concurrency) as (espo_client, _, _, _):
+        return await reconcile_payments_async(espo_payments, transactions, espo_client)
 
 
 @click.command()
 @click.option('--beneficiaries', '-b', is_flag=True, default=False, help="Create beneficiaries.")
 @click.option('--topup', '-t', is_flag=True, default=False, help="Create top-up request.")
+@click.option('--workers', '-w', type=int, default=1, show_default=True,
+              help="Number of concurrent workers used to push beneficiaries.")
+@click.option('--bulk', is_flag=True, default=False,
+              help="Create or update beneficiaries with excel imports instead of one request per beneficiary.")
+@click.option('--incremental', '-i', is_flag=True, default=False,
+              help="Push only beneficiaries changed since the last successful sync.")
+@click.option('--force-refresh', '-f', is_flag=True, default=False,
+              help="Update beneficiaries in RedRose even if unchanged since the last push.")
+@click.option('--batch-mapping', is_flag=True, default=False,
+              help="Map beneficiaries a page at a time with vectorized pandas operations.")
+@click.option('--cache-transactions', is_flag=True, default=False,
+              help="Keep RedRose transactions locally and fetch only the new ones.")
+@click.option('--transactions-page-size', type=int, default=None,
+              help="Fetch RedRose transactions in pages of this size.")
+@click.option('--save-topup-files', is_flag=True, default=False,
+              help="Save a copy of the top-up files sent to RedRose under data/, for audit.")
+@click.option('--metrics-json', type=click.Path(dir_okay=False), default=None,
+              help="Write a JSON report of step timings and HTTP metrics to this file.")
+@click.option('--metrics-prom', type=click.Path(dir_okay=False), default=None,
+              help="Write step timings and HTTP metrics to this file in Prometheus textfile format.")
+@click.option('--record', type=click.Path(dir_okay=False), default=None,
+              help="Record the responses of EspoCRM and RedRose to this cassette file (gzipped JSON lines).")
+@click.option('--replay', type=click.Path(exists=True, dir_okay=False), default=None,
+              help="Replay the responses recorded in this cassette file instead of calling EspoCRM and RedRose.")
+@click.option('--replay-latency', type=float, default=0., show_default=True,
+              help="When replaying, wait the recorded latency of each request multiplied by this factor.")
+@click.option('--shard', default=None,
+              help="Sync only the beneficiaries of shard i of n (i/n, from 0/n), e.g. one per container replica. "
+                   "Top-ups run only in shard 0.")
+@click.option('--processes', '-p', type=int, default=1, show_default=True,
+              help="Sync beneficiaries in this number of processes, each with its own clients and share of records.")
+@click.option('--serve', 'serve_mode', is_flag=True, default=False,
+              help="Keep running: push records to RedRose as EspoCRM webhooks report changes.")
+@click.option('--host', default='127.0.0.1', show_default=True, help="Address of the webhook endpoint.")
+@click.option('--port', type=int, default=8080, show_default=True, help="Port of the webhook endpoint.")
+@click.option('--resync-interval', type=float, default=3600., show_default=True,
+              help="In serve mode, seconds between full syncs of beneficiaries and top-ups.")
+@click.option('--topup-interval', type=float, default=60., show_default=True,
+              help="In serve mode, minimum seconds between top-ups triggered by webhooks.")
+@click.option('--async', 'use_async', is_flag=True, default=False,
+              help="Push beneficiaries, create top-ups and reconcile payments with async clients from one "
+                   "event loop instead of worker threads.")
+@click.option('--concurrency', type=int, default=100, show_default=True,
+              help="With --async, maximum number of beneficiaries or top-up requests in flight at the same time.")
 @click.option('--verbose', '-v', is_flag=True, default=False, help="Print more output.")
-def main(beneficiaries, topup, verbose):
+def main(beneficiaries, topup, workers, bulk, incremental, force_refresh, batch_mapping, cache_transactions,
+         transactions_page_size, save_topup_files, metrics_json, metrics_prom, record, replay, replay_latency,
+         shard, processes, serve_mode, host, port, resync_interval, topup_interval, use_async, concurrency, verbose):
 
     # Setup APIs
     if verbose:
         logging.info(f'setting up APIs')
         logging.info(f'from EspoCRM: {os.getenv("ESPOURL")}')
         logging.info(f'to RedRose: {os.getenv("RRURL")}')
-    df_map = pd.read_csv('../data/esporedrosemapping.csv')
-    espo_client = EspoAPI(os.getenv("ESPOURL"), os.getenv("ESPOAPIKEY"))
-    redrose_client = RedRoseAPI(os.getenv("RRURL"), os.getenv("RRAPIUSER"), os.getenv("RRAPIKEY"),
-                                os.getenv("RRMODULE"))
-    redrose_pay_client = RedRosePaymentsAPI(host_name=os.getenv("RRURL").replace("https://", ""),
-                                            user_name=os.getenv("RRAPIUSER"),
-                                            password=os.getenv("RRAPIKEY"))
+    mapping = read_mapping('../data/esporedrosemapping.csv')
+    # a long-running process reports the totals of the steps since it started
+    metrics = Metrics(accumulate_steps=serve_mode)
+    if record is not None and replay is not None:
+        raise click.UsageError("--record and --replay cannot be used together")
+    if shard is not None:
+        try:
+            shard = parse_shard(shard)
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint='--shard')
+    if processes > 1 and (record is not None or replay is not None):
+        raise click.UsageError("--processes cannot be used with --record or --replay")
+    if serve_mode and (shard is not None or processes > 1):
+        raise click.UsageError("--serve cannot be used with --shard or --processes")
+    if use_async and (bulk or serve_mode or record is not None or replay is not None):
+        raise click.UsageError("--async cannot be used with --bulk, --serve, --record or --replay")
+    if concurrency < 1:
+        raise click.BadParameter("must be at least 1", param_hint='--concurrency')
+    cassette = None
+    replay_dir, local_paths = None, {}
+    if record is not None:
+        cassette = Cassette(record, 'record')
+    elif replay is not None:
+        cassette = Cassette(replay, 'replay', latency_factor=replay_latency)
+        # a replay starts from an empty state store and journal, and leaves those of real runs untouched
+        replay_dir = tempfile.mkdtemp(prefix='espo2redrose-replay-')
+        local_paths = {'STATEPATH': os.getenv("STATEPATH"), 'JOURNALPATH': os.getenv("JOURNALPATH")}
+        os.environ['STATEPATH'] = os.path.join(replay_dir, 'state.db')
+        os.environ['JOURNALPATH'] = os.path.join(replay_dir, 'journal.jsonl')
+    espo_client, redrose_client, redrose_pay_client, poller = setup_clients(workers, metrics, cassette)
+
+    def write_metrics():
+        if metrics_json is not None:
+            metrics.write_json(metrics_json)
+        if metrics_prom is not None:
+            metrics.write_prometheus(metrics_prom)
+
+    options = dict(workers=workers, bulk=bulk, force_refresh=force_refresh, batch_mapping=batch_mapping,
+                   cache_transactions=cache_transactions, transactions_page_size=transactions_page_size,
+                   save_topup_files=save_topup_files, send_audit=replay is None,
+                   concurrency=concurrency if use_async else None, verbose=verbose)
+    try:
+        if serve_mode:
+            serve(mapping, espo_client, redrose_client, redrose_pay_client, poller, metrics, host, port,
+                  resync_interval, topup_interval, write_metrics, **options)
+        elif beneficiaries and processes > 1:
+            run_shards(mapping, metrics, sub_shards(shard, processes), incremental=incremental, **options)
+            run(mapping, espo_client, redrose_client, redrose_pay_client, poller, metrics, topup=topup, shard=shard,
+                **options)
+        else:
+            run(mapping, espo_client, redrose_client, redrose_pay_client, poller, metrics,
+                beneficiaries=beneficiaries, topup=topup, incremental=incremental, shard=shard, **options)
+    except BaseException:
+        metrics.finish(success=False)
+        raise
+    else:
+        metrics.finish(success=True)
+    finally:
+        if cassette is not None:
+            cassette.close()
+        if replay_dir is not None:
+            for name, path in local_paths.items():
+                if path is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = path
+            shutil.rmtree(replay_dir, ignore_errors=True)
+        write_metrics()
+
+
+def run_shards(mapping, metrics, shards, **options):
+    """Sync beneficiaries in one process per shard and merge the shards' reports into metrics"""
+    failed = []
+    with ProcessPoolExecutor(max_workers=len(shards), mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = {executor.submit(run_shard, mapping, shard, options): shard for shard in shards}
+        for future, shard in futures.items():
+            try:
+                metrics.merge(future.result())
+            except Exception as e:
+                logging.error(f"shard {shard[0]}/{shard[1]} failed: {e}")
+                failed.append(shard)
+    if failed:
+        raise RuntimeError(f"{len(failed)} of {len(shards)} shards failed")
+
+
+def run_shard(mapping, shard, options):
+    """Sync the beneficiaries of a shard with new clients (in a child process), return the run report"""
+    metrics = Metrics()
+    espo_client, redrose_client, redrose_pay_client, poller = setup_clients(options['workers'], metrics)
+    run(mapping, espo_client, redrose_client, redrose_pay_client, poller, metrics, beneficiaries=True, shard=shard,
+        **options)
+    metrics.finish(success=True)
+    return metrics.to_dict()
+
+
+def serve(mapping, espo_client, redrose_client, redrose_pay_client, poller, metrics, host, port, resync_interval,
+          topup_interval, write_metrics, **options):
+    """Serve mode: receive EspoCRM webhook calls and push the changed beneficiaries to RedRose as they arrive,
+    with the same clients for the whole process. Payments ready for payment trigger the top-up step
+    (at most every topup_interval seconds). As a safety net against missed calls, all changed beneficiaries
+    and due payments are synced at start and every resync_interval seconds."""
+    mapping_bnf = [row for row in mapping if row['action'] == 'Create bnf']
+    entity_names = list(dict.fromkeys(row['espo.entity'] for row in mapping_bnf))
+    queue = ChangeQueue()
+    # an empty secret means no signature check
+    secret = os.getenv("WEBHOOK_SECRET") or None
+    server = WebhookServer((host, port), queue, entity_names + ['Payment'], secret).start()
+    resync = Schedule(resync_interval)
+    topup = Schedule(topup_interval)
+    payments_changed = False
+    state_store = StateStore(os.getenv("STATEPATH", DEFAULT_STATE_PATH))
+
+    try:
+        while True:
+            timeout = min(resync.seconds_left(), topup.seconds_left()) if payments_changed else resync.seconds_left()
+            changes = queue.take(timeout)
+            # records may have changed in EspoCRM since the previous job
+            espo_client.invalidate()
+            try:
+                for entity_name in entity_names:
+                    if changes.get(entity_name):
+                        mapping_ = [row for row in mapping_bnf if row['espo.entity'] == entity_name]
+                        sync_changes(entity_name, mapping_, changes[entity_name], espo_client, redrose_client,
+                                     metrics, state_store, options)
+                payments_changed = payments_changed or bool(changes.get('Payment'))
+                if resync.due():
+                    logging.info("syncing all changed beneficiaries and due payments")
+                    run(mapping, espo_client, redrose_client, redrose_pay_client, poller, metrics,
+                        beneficiaries=True, topup=True, incremental=True, **options)
+                    resync.done()
+                    topup.done()
+                    payments_changed = False
+                elif payments_changed and topup.due():
+                    run(mapping, espo_client, redrose_client, redrose_pay_client, poller, metrics, topup=True,
+                        **options)
+                    topup.done()
+                    payments_changed = False
+            except Exception as e:
+                # the records of a failed job are synced again at the next resync
+                logging.error(f"sync failed: {e}")
+            write_metrics()
+    except KeyboardInterrupt:
+        logging.info("stopping")
+    finally:
+        server.shutdown()
+        server.server_close()
+        state_store.close()
+
+
+def sync_changes(entity_name, mapping_, ids, espo_client, redrose_client, metrics, state_store, options):
+    """Create or update in RedRose the beneficiaries reported by webhook calls"""
+    if options['verbose']:
+        logging.info(f"syncing {len(ids)} changed records of {entity_name}")
+    with metrics.step('webhook') as step, closing(Journal(os.getenv("JOURNALPATH", DEFAULT_JOURNAL_PATH))) as journal:
+        for i in range(0, len(ids), WEBHOOK_BATCH_SIZE):
+            stats = sync_beneficiaries(entity_name, mapping_, espo_client, redrose_client,
+                                       workers=options['workers'], params=ids_params(ids[i:i + WEBHOOK_BATCH_SIZE]),
+                                       state_store=state_store, force_refresh=options['force_refresh'],
+                                       batch_mapping=options['batch_mapping'], journal=journal,
+                                       verbose=options['verbose'])
+            step['records'] += stats['created'] + stats['updated'] + stats['skipped'] + stats['resumed'] + \
+                stats['failed']
+            if stats['failed']:
+                logging.warning(f"{entity_name}: {stats['failed']} beneficiaries failed, "
+                                f"they will be retried at the next resync")
+        journal.clear('beneficiaries')
+
+
+def run(mapping, espo_client, redrose_client, redrose_pay_client, poller, metrics, beneficiaries=False, topup=False,
+        workers=1, bulk=False, incremental=False, force_refresh=False, batch_mapping=False, cache_transactions=False,
+        transactions_page_size=None, save_topup_files=False, send_audit=True, shard=None, concurrency=None,
+        verbose=False):
 
     ####################################################################################################################
 
@@ -72,320 +377,196 @@ def main(beneficiaries, topup, verbose):
         if verbose:
             logging.info(f"Step 1: Create or update beneficiaries in RedRose")
 
-        df_map_bnf = df_map[df_map['action'] == 'Create bnf']
-
-        for entity_name in df_map_bnf['espo.entity'].unique():
-
-            df_map_ = df_map_bnf[df_map_bnf['espo.entity'] == entity_name]
-
-            # get approved entities from EspoCRM
-            entity_list = espo_client.request('GET', entity_name)['list']
-            if verbose:
-                logging.info(f'updating {len(entity_list)} beneficiaries')
-
-            for entity in entity_list:
-
-                # prepare payload for RedRose
-                payload = {}
-                for ix, row in df_map_.iterrows():
-                    if row['espo.field'] in entity.keys():
-                        payload[row['redrose.field']] = unidecode(str(entity[row['espo.field']]))
+        # each shard keeps its own journal and watermarks
+        with metrics.step('beneficiaries') as step, \
+                closing(StateStore(os.getenv("STATEPATH", DEFAULT_STATE_PATH))) as state_store, \
+                closing(Journal(shard_key(os.getenv("JOURNALPATH", DEFAULT_JOURNAL_PATH), shard))) as journal:
+            mapping_bnf = [row for row in mapping if row['action'] == 'Create bnf']
+
+            for entity_name in dict.fromkeys(row['espo.entity'] for row in mapping_bnf):
+
+                mapping_ = [row for row in mapping_bnf if row['espo.entity'] == entity_name]
+
+                # in incremental mode, get only entities changed since the last successful sync
+                params = None
+                # minus an overlap, in case the local clock is ahead of EspoCRM's
+                # (records pushed again are skipped by their payload hash)
+                overlap = timedelta(seconds=float(os.getenv("WATERMARK_OVERLAP", 300)))
+                sync_started_at = (datetime.utcnow() - overlap).strftime("%Y-%m-%d %H:%M:%S")
+                if incremental:
+                    watermark = state_store.get_watermark(shard_key(entity_name, shard))
+                    if watermark is not None:
+                        params = modified_since_params(watermark)
+                    if verbose:
+                        logging.info(f'last successful sync of {entity_name}: {watermark}')
+
+                # get approved entities from EspoCRM page by page and push them to RedRose
+                if verbose:
+                    logging.info(f'updating beneficiaries of {entity_name}')
+                if bulk:
+                    stats = sync_beneficiaries_bulk(entity_name, mapping_, espo_client, redrose_pay_client, poller,
+                                                    workers=workers, params=params, state_store=state_store,
+                                                    force_refresh=force_refresh, batch_mapping=batch_mapping,
+                                                    journal=journal, shard=shard, verbose=verbose)
+                elif concurrency is not None:
+                    # async mode: up to concurrency pushes in flight in one event loop
+                    stats = asyncio.run(sync_entity_async(entity_name, mapping_, metrics, concurrency, params=params,
+                                                          state_store=state_store, force_refresh=force_refresh,
+                                                          batch_mapping=batch_mapping, journal=journal, shard=shard,
+                                                          verbose=verbose))
+                else:
+                    stats = sync_beneficiaries(entity_name, mapping_, espo_client, redrose_client, workers=workers,
+                                               params=params, state_store=state_store, force_refresh=force_refresh,
+                                               batch_mapping=batch_mapping, journal=journal, shard=shard,
+                                               verbose=verbose)
+                step['records'] += stats['created'] + stats['updated'] + stats['skipped'] + stats['resumed'] + \
+                    stats['failed']
+                if verbose:
+                    logging.info(f"{entity_name}: {stats['created']} created, {stats['updated']} updated, "
+                                 f"{stats['skipped']} unchanged, {stats['resumed']} already pushed by an "
+                                 f"interrupted run, {stats['failed']} failed")
+
+                # advance the watermark only if all beneficiaries were pushed
+                if incremental:
+                    if stats['failed'] == 0:
+                        state_store.set_watermark(shard_key(entity_name, shard), sync_started_at)
                     else:
-                        logging.error(f"ERROR: field {row['espo.field']} not found in EspoCRM !!!")
+                        logging.warning(f"{entity_name}: {stats['failed']} beneficiaries failed, "
+                                        f"they will be retried at the next incremental run")
 
-                # mark all beneficiaries as approved
-                payload['m.beneficiaryStatus'] = 'Approved'
-
-                # post data to RedRose
-                if pd.isna(entity["redroseInternalID"]):  # create new beneficiary
-                    if verbose:
-                        logging.info(f'creating beneficiary: {payload}')
-                    try:
-                        rr_data = redrose_client.request('POST', 'importBeneficiaryWithIqId', files=payload)
-                    except RedRoseAPIError:
-                        logging.error('create beneficiary failed!')
-                        continue
-                    update_redrose_id(rr_data, entity_name, entity, espo_client)
-                else:  # if beneficiary already exists, update it
-                    if verbose:
-                        logging.info(f'updating beneficiary: {payload}')
-                    try:
-                        params = {'beneficiaryIqId': payload['m.iqId']}
-                        redrose_client.request('POST', 'updateBeneficiaryByIqId', params=params, files=payload)
-                    except RedRoseAPIError:
-                        logging.error('update failed!')
-                        continue
+            # all entities were synced: a new run starts from scratch
+            journal.clear('beneficiaries')
 
     ####################################################################################################################
 
     # 2. Create top-up request(s) in RedRose
-    if topup:
+    if topup and shard is not None and shard[0] != 0:
+        logging.info(f"Top-up requests are created by shard 0, not by shard {shard[0]}/{shard[1]}")
+    elif topup:
+        # only the top-up and audit steps need pandas, sendgrid and xlsxwriter
+        import pandas as pd
+        from pipeline.topup import create_topups
+        from pipeline.audit import create_audit_file, send_audit_file, AUDIT_PAYMENT_FIELDS
+
         if verbose:
             logging.info(f"Step 2: Create top-up requests in RedRose")
 
-        df_map_pay = df_map[df_map['action'] == 'Create topup']
-
-        # select approved payments which are due today or in the past
-        params = {
-            "select": "id,internalId,amount,rrActivity",
-            "where": [
-                {
-                    "type": "and",
-                    "value": [
-                        {
-                            "type": "equals",
-                            "attribute": "status",
-                            "value": "readyforpayment"
-                        },
-                        {
-                            "type": "or",
-                            "value": [
-                                {
-                                    "type": "today",
-                                    "attribute": "date"
-                                },
-                                {
-                                    "type": "past",
-                                    "attribute": "date"
-                                }
-                            ]
-                        }
-                    ]
-                }
-            ]
-        }
-        payment_data = espo_client.request('GET', 'Payment', params)['list']
-
-        # create a top-up request for each activity
-        df_espo_pay = pd.DataFrame(payment_data)
-        if len(df_espo_pay) > 0:
-            if verbose:
-                logging.info(f'creating top-up requests for {len(df_espo_pay)} payments')
-            df_espo_pay = df_espo_pay[['id']+list(df_map_pay['espo.field'].unique())]  # keep only relevant fields
-            topup_files, topup_payment_ids = {}, {}
-            for activity in df_espo_pay['rrActivity'].unique():
-                topup_files[activity], topup_payment_ids[activity] = [], []
-                df_espo_pay_activity = df_espo_pay[df_espo_pay['rrActivity'] == activity]
-                # if more than MAX_NUMBER_PAYMENTS, split and create multiple topup requests
-                if len(df_espo_pay_activity) > MAX_NUMBER_PAYMENTS:
-                    list_df = [df_espo_pay_activity[i:i + MAX_NUMBER_PAYMENTS].copy()
-                               for i in range(0, len(df_espo_pay_activity), MAX_NUMBER_PAYMENTS)]
-                    for ndf, df in enumerate(list_df):
-                        topup_file = f"../data/IndividualTopup-{activity}-{ndf}.xlsx"
-                        df.drop(columns=['id', 'rrActivity']).to_excel(topup_file, index=False)
-                        topup_files[activity].append(topup_file)
-                        topup_payment_ids[activity].append(list(df['id'].unique()))
+        with metrics.step('topup') as step:
+            mapping_pay = [row for row in mapping if row['action'] == 'Create topup']
+
+            # select approved payments which are due today or in the past
+            params = {
+                "select": "id,internalId,amount,rrActivity",
+                "where": [
+                    {
+                        "type": "and",
+                        "value": [
+                            {
+                                "type": "equals",
+                                "attribute": "status",
+                                "value": "readyforpayment"
+                            },
+                            {
+                                "type": "or",
+                                "value": [
+                                    {
+                                        "type": "today",
+                                        "attribute": "date"
+                                    },
+                                    {
+                                        "type": "past",
+                                        "attribute": "date"
+                                    }
+                                ]
+                            }
+                        ]
+                    }
+                ]
+            }
+            payment_data = list(espo_client.request_list('Payment', params))
+
+            # create a top-up request for each activity
+            # and resume the top-up requests of an interrupted run, if any
+            df_espo_pay = pd.DataFrame(payment_data)
+            step['records'] = len(df_espo_pay)
+            if len(df_espo_pay) > 0:
+                if verbose:
+                    logging.info(f'creating top-up requests for {len(df_espo_pay)} payments')
+                # keep only relevant fields
+                df_espo_pay = df_espo_pay[['id'] + list(dict.fromkeys(row['espo.field'] for row in mapping_pay))]
+            else:
+                logging.info("No payments in EspoCRM with status=readyforpayment")
+            with closing(Journal(os.getenv("JOURNALPATH", DEFAULT_JOURNAL_PATH))) as journal:
+                topup_options = dict(save_dir='../data' if save_topup_files else None, journal=journal,
+                                     max_age=float(os.getenv("TOPUP_RESUME_MAX_AGE", 172800)),
+                                     max_attempts=int(os.getenv("TOPUP_RESUME_MAX_ATTEMPTS", 5)),
+                                     verbose=verbose)
+                if concurrency is not None:
+                    # async mode: all uploads, polls and write-backs from one event loop
+                    unfinished = asyncio.run(create_topups_with_async_clients(df_espo_pay, metrics, concurrency,
+                                                                              **topup_options))
+                    # payments were updated by the async client, bypassing the cache of this one
+                    espo_client.invalidate('Payment')
                 else:
-                    topup_file = f"../data/IndividualTopup-{activity}.xlsx"
-                    df_espo_pay_activity.drop(columns=['id', 'rrActivity']).to_excel(topup_file, index=False)
-                    topup_files[activity].append(topup_file)
-                    topup_payment_ids[activity].append(list(df_espo_pay_activity['id'].unique()))
-
-            # upload each top-up request to RedRose and print output
-            for activity, topup_file_list in topup_files.items():
-                for topup_file, payment_ids in zip(topup_file_list, topup_payment_ids[activity]):
-                    logging.info(f"sending {topup_file.replace('../data/', '')} with {len(payment_ids)} payments")
-                    upload_result_id = redrose_pay_client.upload_individual_distribution_excel(
-                        filename=os.path.basename(topup_file),
-                        file_path=topup_file,
-                        activity_id=activity)
-                    upload_result = redrose_pay_client.get_excel_import_status(upload_result_id)
-                    while upload_result['status'] not in ['SUCCEEDED', 'FAILED']:
-                        upload_result = redrose_pay_client.get_excel_import_status(upload_result_id)
-                    if upload_result['status'] == 'FAILED':
-                        logging.error(f"Top-up request submitted, status FAILED")
-                    elif verbose:
-                        logging.info(f"Top-up request submitted, status {upload_result['status']}")
-
-                    # if top-up request succeeded update corresponding payments' status
-                    for payment_id in payment_ids:
-                        if upload_result['status'] == 'SUCCEEDED':
-                            espo_client.request('PUT', f"Payment/{payment_id}", {
-                                "status": "Pending",
-                                "dateTopup": datetime.today().strftime("%Y-%m-%d")
-                            })
-                        elif upload_result['status'] == 'FAILED':
-                            espo_client.request('PUT', f"Payment/{payment_id}", {"status": "Failed"})
-        else:
-            logging.info("No payments in EspoCRM with status=readyforpayment")
+                    unfinished = create_topups(df_espo_pay, espo_client, redrose_pay_client, poller, metrics=metrics,
+                                               **topup_options)
+                # keep the top-up requests whose payments were not updated in the journal,
+                # so that the next run does not send them again
+                if not unfinished:
+                    journal.clear('topup')
 
         ################################################################################################################
 
+        # pending payments, with the fields needed by both the audit file and the reconciliation
+        payments_params = open_payments_params(list(dict.fromkeys(RECONCILIATION_FIELDS + AUDIT_PAYMENT_FIELDS)))
+
         # 3. Create audit file and send it around if a top-up request was created
         if len(df_espo_pay) > 0:
-            logging.info("Creating audit file")
-            # Create audit file and define function to create excel hyperlinks
-            writer = pd.ExcelWriter('auditfile.xlsx', engine='xlsxwriter')
-
-            # Get due payments and write to excel
-            paymentsEspo = espo_client.request('GET', "Payment")['list']
-            payments = pd.json_normalize(paymentsEspo)
-            payments = payments.loc[payments['status'] == "Pending"]
-            logging.info(payments)
-            payments = payments.reset_index()
-            paymentsoverview = payments[[
-                    'shelterID', 'date', 'amount', 'amountCurrency', 'status', 'numPayment', 'modifiedAt',
-                    'shelterName', 'numberOfPayments'
-                ]]
-
-            # Get associated shelterIds from payments
-            shelterIds = payments.shelterId.unique()
-
-            # Get changes for beneficiaries associated to payments and write to excel
-            paymentchanges = []
-            paymentsto = []
-
-            for id in shelterIds:
-                stream = espo_client.request('GET', f"Shelter/{id}/stream")['list']
-                dfs = pd.read_json(json.dumps(stream))
-                if dfs.empty:
-                    pass
+            with metrics.step('audit') as step:
+                logging.info("Creating audit file")
+                step['records'] = create_audit_file(espo_client, 'auditfile.xlsx', os.getenv("ESPOURL"),
+                                                    payments_params)
+                if step['records'] > 0 and not send_audit:
+                    logging.info("Audit file not sent (replayed run)")
+                elif step['records'] > 0:
+                    logging.info("Sending audit file around")
+                    send_audit_file('auditfile.xlsx')
                 else:
-                    dfs = dfs.loc[dfs['type'] == 'Update']
-                    paymentchanges.append(dfs)
-
-                to = espo_client.request('GET', f"Shelter/{id}")
-                dfto = pd.json_normalize(to)
-                if dfto.empty:
-                    pass
-                else:
-                    paymentsto.append(dfto)
-
-            if paymentchanges == []:
-                paymentchanges = pd.DataFrame(['no payment info was changed by users in this batch'],
-                                              columns=['Paymentchanges'])
-            else:
-                paymentchanges = pd.concat(paymentchanges)
-                paymentchanges['Link'] = paymentchanges['parentId'].apply(
-                    lambda x: make_hyperlink(os.getenv("ESPOURL"), x))
-                paymentchanges = paymentchanges[['data', 'createdAt', 'createdByName', 'parentId', 'Link']]
-                paymentchanges.rename(columns={'data': 'Changes'}, inplace=True)
-                paymentchanges.rename(columns={'parentId': 'EspoCRM ID'}, inplace=True)
-
-            if len(paymentsto) > 0:
-                paymentsto = pd.concat(paymentsto)
-
-                paymentsto["Payment to"] = paymentsto["rrName"] + " " + paymentsto["rrSurname"]
-                paymentsto = paymentsto[[
-                    'shelterID', 'Payment to', 'contactName', 'id', 'status', 'accType', 'modifiedByName',
-                    'ibanpayment', 'paymentBankName', 'bicPayment', 'gh0', 'gh1', 'reasonIbanChange'
-                ]]
-                paymentsto.rename(columns={'id': 'EspoCRM ID'}, inplace=True)
-                paymentsID = paymentsto[['EspoCRM ID', 'shelterID']]
-
-                paymentchanges = pd.merge(paymentchanges, paymentsID, on='EspoCRM ID', how='left')
-                paymentchanges = paymentchanges[['shelterID', 'Changes', 'createdAt', 'createdByName', 'Link']]
-
-                consolidated = pd.merge(paymentsoverview, paymentsto, on='shelterID', how='left')
-                consolidated = consolidated[[
-                    'shelterID', 'amount', 'amountCurrency', 'status_x', 'numPayment','numberOfPayments', 'Payment to',
-                    'contactName', 'status_y', 'accType', 'gh0', 'gh1', 'reasonIbanChange'
-                ]]
-                consolidated.rename(
-                    columns={'status_x': 'Payment Status',
-                             'status_y': 'Beneficiary Status',
-                             'contactName': 'Beneficiary Name',
-                             'accType': 'Accomodation Type'},
-                    inplace=True)
-
-                # Save audit file
-                consolidated.to_excel(writer, sheet_name='Payment Overview', index=False)
-                paymentchanges.to_excel(writer, sheet_name='Changes', index=False)
-                writer.save()
-
-                logging.info("Sending audit file around")
-                email_from = os.getenv("AUDIT_EMAIL_FROM")
-                email_to1 = os.getenv("AUDIT_EMAIL_TO_1")
-                email_to2 = os.getenv("AUDIT_EMAIL_TO_2")
-                email_to3 = os.getenv("AUDIT_EMAIL_TO_3")
-                email_to4 = os.getenv("AUDIT_EMAIL_TO_4")
-                # Send emails around
-                if email_from is not None and email_to1 is not None and email_to2 is not None and email_to3 is not None and email_to4 is not None:
-                    message = Mail(
-                        from_email=email_from,
-                        to_emails=[To(email_to1), To(email_to2), To(email_to3), To(email_to4)],
-                        subject='Shelter Auditfile',
-                        html_content='This is the audit file for the sheltertopup of today')
-
-                    data = open('auditfile.xlsx', 'rb').read()
-                    encoded_file = base64.b64encode(data).decode('UTF-8')
-
-                    attachedFile = Attachment(
-                        FileContent(encoded_file),
-                        FileName('auditfile.xlsx'),
-                        FileType('application/xlsx'),
-                        Disposition('attachment')
-                    )
-                    message.attachment = attachedFile
-
-                    try:
-                        logging.info(f"SENDGRID_API_KEY {os.getenv('SENDGRID_API_KEY')}")
-                        sg = SendGridAPIClient(os.getenv("SENDGRID_API_KEY"))
-                        response = sg.send(message)
-                        logging.info(response.status_code)
-                        logging.info(response.body)
-                        logging.info(response.headers)
-                    except Exception as e:
-                        logging.error(e)
-            else:
-                logging.warning("No payments found for audit file")
+                    logging.warning("No payments found for audit file")
 
         ################################################################################################################
 
         # 4. Update payment status in EspoCRM
-
-        # get all transactions
-        transactions = redrose_client.request('GET', 'getTransactions')
-        if verbose:
-            logging.info(f"Step 3: Update payment status in EspoCRM")
-            logging.info(f"Found {len(transactions)} transactions in RedRose")
-        # parse date
-        for t in transactions:
-            t['date'] = pd.to_datetime(t['dated']).strftime("%Y-%m-%d")
-        multiple_payments, missing_payments = [], []
-        is_multiple_transaction, is_missing_transaction = False, False
-
-        # for each espo payment
-        espo_payments = espo_client.request('GET', 'Payment')['list']
-        for espo_payment in espo_payments:
-            if espo_payment["status"] == "readyforpayment" or espo_payment["status"] == "Planned":
-                continue
-            shelter_id = espo_payment['shelterID']
-            if not pd.isna(espo_payment['dateTopup']):
-                date = espo_payment['dateTopup']
+        with metrics.step('reconciliation') as step:
+            # get the transactions that can match open payments
+            # the same collection as in the audit file, if no payment was updated since
+            espo_payments = espo_client.request_list_cached('Payment', payments_params)
+            transaction_store = StateStore(os.getenv("STATEPATH", DEFAULT_STATE_PATH)) if cache_transactions else None
+            if concurrency is not None:
+                # async mode: transaction pages fetched concurrently from one event loop
+                transactions = asyncio.run(fetch_transactions_with_async_clients(
+                    espo_payments, metrics, concurrency, state_store=transaction_store,
+                    page_size=transactions_page_size))
             else:
-                date = espo_payment['date']
-            # get transactions for same beneficiary on same date
-            transactions_filtered = [t for t in transactions if t['iqId'] == shelter_id]
-            transactions_filtered_days = []
-            for t in transactions_filtered:
-                datetime_diff = pd.to_datetime(t['date']) - pd.to_datetime(date)
-                datetime_diff_days = datetime_diff.days
-                if 0 < datetime_diff_days < 8:
-                    transactions_filtered_days.append(t)
-
-            # if God is merciful, there is ONE transaction corresponding to ONE payment
-            if len(transactions_filtered_days) == 1:
-                transaction = transactions_filtered_days[0]
-                if 'approved' in transaction['salesStatus'].lower():
-                    espo_client.request('PUT', f'Payment/{espo_payment["id"]}',
-                                        {"status": "Done", "transactionID": transaction['id']})
-                if 'cancelled' in transaction['salesStatus'].lower():
-                    espo_client.request('PUT', f'Payment/{espo_payment["id"]}',
-                                        {"status": "Failed", "transactionID": transaction['id']})
-            # if God is cruel, there are MULTIPLE transactions corresponding to ONE payment, or NO transactions at all
-            elif len(transactions_filtered_days) > 1:
-                multiple_payments += [t["id"] for t in transactions_filtered_days]
-                is_multiple_transaction = True
+                transactions = fetch_transactions(redrose_client, espo_payments, transaction_store,
+                                                  page_size=transactions_page_size)
+            if transaction_store is not None:
+                transaction_store.close()
+            if verbose:
+                logging.info(f"Step 3: Update payment status in EspoCRM")
+                logging.info(f"Found {len(transactions)} transactions in RedRose")
+            if concurrency is not None:
+                multiple_payments, missing_payments = asyncio.run(reconcile_with_async_clients(
+                    espo_payments, transactions, metrics, concurrency))
             else:
-                missing_payments += [espo_payment["id"]]
-                is_missing_transaction = True
-
-        if is_missing_transaction:
-            logging.warning(f'No transactions found for payments {missing_payments}')
-        if is_multiple_transaction:
-            logging.warning(
-                f'Failed to update payments: multiple transactions found for payments {multiple_payments}')
+                multiple_payments, missing_payments = reconcile_payments(espo_payments, transactions, espo_client)
+            step['records'] = len(espo_payments)
+
+            if missing_payments:
+                logging.warning(f'No transactions found for payments {missing_payments}')
+            if multiple_payments:
+                logging.warning(
+                    f'Failed to update payments: multiple transactions found for payments {multiple_payments}')
 
 
 if __name__ == "__main__":
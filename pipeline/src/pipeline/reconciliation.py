@@ -0,0 +1,167 @@
+import logging
+from bisect import bisect_left, bisect_right
+from datetime import date as date_, timedelta
+from pipeline.values import is_missing, parse_day
+
+# a transaction matches a payment if it happened 1 to 7 days after the payment (top-up) date
+MIN_DAYS_AFTER_PAYMENT = 1
+MAX_DAYS_AFTER_PAYMENT = 7
+# stored transactions of the last days are fetched again, as their status may still change
+TRANSACTIONS_REFRESH_DAYS = 8
+# payments whose status can still change after a top-up, and the fields used to reconcile them
+OPEN_PAYMENT_STATUSES = ['Pending']
+RECONCILIATION_FIELDS = ['id', 'shelterID', 'date', 'dateTopup', 'status']
+TRANSACTIONS_FROM_WATERMARK = 'RedRose.getTransactions.from'
+TRANSACTIONS_UNTIL_WATERMARK = 'RedRose.getTransactions.until'
+
+
+def parse_date(value):
+    """Parse a date or datetime string to a day number (proleptic Gregorian ordinal)"""
+    return parse_day(value)
+
+
+def open_payments_params(fields=RECONCILIATION_FIELDS):
+    """EspoCRM query for the payments which are waiting for a transaction, with only the given fields"""
+    return {
+        "select": ",".join(fields),
+        "where": [
+            {
+                "type": "in",
+                "attribute": "status",
+                "value": OPEN_PAYMENT_STATUSES
+            }
+        ]
+    }
+
+
+def is_open(espo_payment):
+    return espo_payment["status"] not in ["readyforpayment", "Planned"]
+
+
+def payment_date(espo_payment):
+    if not is_missing(espo_payment['dateTopup']):
+        return espo_payment['dateTopup']
+    else:
+        return espo_payment['date']
+
+
+def fetch_transactions(redrose_client, espo_payments, state_store=None, page_size=None):
+    """Get the RedRose transactions that can match the given payments, i.e. from the day after the earliest
+    payment date until today. With a state store, transactions already seen are kept locally and only the
+    last TRANSACTIONS_REFRESH_DAYS before the previous fetch are downloaded again."""
+    window = transactions_window(espo_payments, state_store)
+    if window is None:
+        return []
+    day_from, date_from, date_to = window
+    new_transactions = list(redrose_client.get_transactions(date_from, date_to, page_size=page_size))
+    return stored_transactions(new_transactions, day_from, date_from, date_to, state_store)
+
+
+async def fetch_transactions_async(redrose_client, espo_payments, state_store=None, page_size=None):
+    """fetch_transactions for an async RedRose client"""
+    window = transactions_window(espo_payments, state_store)
+    if window is None:
+        return []
+    day_from, date_from, date_to = window
+    new_transactions = [t async for t in redrose_client.get_transactions(date_from, date_to, page_size=page_size)]
+    return stored_transactions(new_transactions, day_from, date_from, date_to, state_store)
+
+
+def transactions_window(espo_payments, state_store=None):
+    """First day (ordinal) of the transactions that can match the payments, and the dates (YYYY-MM-DD) of those
+    to download, or None if no payment is open"""
+    days = [parse_date(payment_date(p)) for p in espo_payments if is_open(p)]
+    if not days:
+        return None
+    day_from = min(days) + MIN_DAYS_AFTER_PAYMENT
+    date_to = date_.today().strftime("%Y-%m-%d")
+    fetch_from = day_from
+    if state_store is not None:
+        # fetch again only the last days of the stored history, unless it does not go back far enough
+        covered_from = state_store.get_watermark(TRANSACTIONS_FROM_WATERMARK)
+        fetched_until = state_store.get_watermark(TRANSACTIONS_UNTIL_WATERMARK)
+        if covered_from is not None and fetched_until is not None and day_from >= parse_date(covered_from):
+            fetch_from = max(day_from, parse_date(fetched_until) - TRANSACTIONS_REFRESH_DAYS)
+    return day_from, date_.fromordinal(fetch_from).strftime("%Y-%m-%d"), date_to
+
+
+def stored_transactions(new_transactions, day_from, date_from, date_to, state_store=None):
+    """With a state store, save the downloaded transactions and return all stored ones since day_from"""
+    if state_store is None:
+        return new_transactions
+    logging.info(f"Fetched {len(new_transactions)} transactions since {date_from} from RedRose")
+    covered_from = state_store.get_watermark(TRANSACTIONS_FROM_WATERMARK)
+    state_store.save_transactions(new_transactions, lambda t: parse_date(t['dated']))
+    if covered_from is None or day_from < parse_date(covered_from):
+        state_store.set_watermark(TRANSACTIONS_FROM_WATERMARK, date_from)
+    state_store.set_watermark(TRANSACTIONS_UNTIL_WATERMARK, date_to)
+    return state_store.get_transactions(day_from, (date_.today() + timedelta(days=1)).toordinal())
+
+
+class TransactionIndex:
+    """RedRose transactions grouped by iqId, with dates parsed once and sorted"""
+
+    def __init__(self, transactions):
+        groups = {}
+        for position, t in enumerate(transactions):
+            groups.setdefault(t['iqId'], []).append((parse_date(t['dated']), position, t))
+        self.index = {}
+        for iq_id, group in groups.items():
+            group.sort(key=lambda x: (x[0], x[1]))
+            self.index[iq_id] = ([x[0] for x in group], group)
+
+    def find(self, iq_id, date):
+        """Return the transactions of a beneficiary within the matching window after a date, in original order"""
+        if iq_id not in self.index:
+            return []
+        days, group = self.index[iq_id]
+        day = parse_date(date)
+        start = bisect_left(days, day + MIN_DAYS_AFTER_PAYMENT)
+        end = bisect_right(days, day + MAX_DAYS_AFTER_PAYMENT)
+        return [t for _, _, t in sorted(group[start:end], key=lambda x: x[1])]
+
+
+def reconcile_payments(espo_payments, transactions, espo_client):
+    """Update the status of EspoCRM payments based on the corresponding RedRose transactions.
+    Returns the ids of transactions matching more than one payment and of payments without transactions."""
+    updates, multiple_payments, missing_payments = payment_updates(espo_payments, transactions)
+    # each update carries its own transactionID, identical changes (if any) are grouped in mass updates
+    espo_client.batch_update('Payment', updates)
+    return multiple_payments, missing_payments
+
+
+async def reconcile_payments_async(espo_payments, transactions, espo_client):
+    """reconcile_payments for an async EspoCRM client"""
+    updates, multiple_payments, missing_payments = payment_updates(espo_payments, transactions)
+    await espo_client.batch_update('Payment', updates)
+    return multiple_payments, missing_payments
+
+
+def payment_updates(espo_payments, transactions):
+    """(id, changes) of the payments matched to a transaction, the ids of transactions matching more than one
+    payment and of payments without transactions"""
+    index = TransactionIndex(transactions)
+    multiple_payments, missing_payments = [], []
+    updates = []
+
+    for espo_payment in espo_payments:
+        if not is_open(espo_payment):
+            continue
+        shelter_id = espo_payment['shelterID']
+        date = payment_date(espo_payment)
+        # get transactions for same beneficiary in the days after the payment
+        transactions_filtered_days = index.find(shelter_id, date)
+
+        # if God is merciful, there is ONE transaction corresponding to ONE payment
+        if len(transactions_filtered_days) == 1:
+            transaction = transactions_filtered_days[0]
+            if 'approved' in transaction['salesStatus'].lower():
+                updates.append((espo_payment["id"], {"status": "Done", "transactionID": transaction['id']}))
+            if 'cancelled' in transaction['salesStatus'].lower():
+                updates.append((espo_payment["id"], {"status": "Failed", "transactionID": transaction['id']}))
+        # if God is cruel, there are MULTIPLE transactions corresponding to ONE payment, or NO transactions at all
+        elif len(transactions_filtered_days) > 1:
+            multiple_payments += [t["id"] for t in transactions_filtered_days]
+        else:
+            missing_payments += [espo_payment["id"]]
+    return updates, multiple_payments, missing_payments
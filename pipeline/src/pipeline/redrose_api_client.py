@@ -1,8 +1,11 @@
-import requests
 import urllib
 import json
 from requests.auth import HTTPBasicAuth
 import uuid
+import time
+import logging
+from pipeline.http_session import create_session
+from pipeline.values import parse_day
 
 
 class RedRoseAPIError(Exception):
@@ -42,39 +45,114 @@ def http_build_query(data):
 class RedRoseAPI:
 
     url_path = '/externalapi/'
+    # query parameters of getTransactions
+    transactions_date_from_param = 'dateFrom'
+    transactions_date_to_param = 'dateTo'
+    transactions_page_param = 'page'
+    transactions_page_size_param = 'pageSize'
 
-    def __init__(self, url, api_user, api_key, module):
+    def __init__(self, url, api_user, api_key, module, session=None, cassette=None):
         self.url = url
         self.api_user = api_user
         self.api_key = api_key
         self.module = module
         self.status_code = None
+        self.session = session if session is not None else create_session(cassette=cassette)
 
     def request(self, method, action, params=None, files=None):
 
         kwargs = {
-            'url': self.normalize_url(action),
+            'url': self.request_url(action, params),
             'auth': (self.api_user, self.api_key),
         }
 
         if files is not None:
-            kwargs['files'] = [('keyValuePair', ('keyValuePair', json.dumps(files), 'application/json'))]
-        if params is not None:
-            kwargs['url'] = kwargs['url'] + '?' + http_build_query(params)
+            kwargs['files'] = self.key_value_files(files)
 
-        response = requests.request(method, **kwargs)
+        response = self.session.request(method, **kwargs)
 
         self.status_code = response.status_code
+        self.check_response(response)
+
+        return response.json()
+
+    def request_url(self, action, params=None):
+        # shared with the async client
+        url = self.normalize_url(action)
+        if params is not None:
+            url = url + '?' + http_build_query(params)
+        return url
+
+    @staticmethod
+    def key_value_files(files):
+        # multipart body of the external API: the fields as JSON in a 'keyValuePair' file
+        return [('keyValuePair', ('keyValuePair', json.dumps(files), 'application/json'))]
 
-        if self.status_code != 200:
-            reason = self.parse_reason(response.headers)
+    @staticmethod
+    def check_response(response):
+        if response.status_code != 200:
+            reason = RedRoseAPI.parse_reason(response.headers)
             raise RedRoseAPIError(f'Wrong request, status code is {response.status_code}, reason is {reason}')
 
         data = response.content
         if not data:
             raise RedRoseAPIError('Wrong request, content response is empty')
 
-        return response.json()
+    def get_transactions(self, date_from=None, date_to=None, page_size=None):
+        """Iterate over transactions, optionally only those between two dates (YYYY-MM-DD) and page by page"""
+        params = self.transactions_params(date_from, date_to)
+        if page_size is None:
+            yield from self.request('GET', 'getTransactions', params=params or None)
+            return
+
+        page, seen_ids = 0, set()
+        while True:
+            transactions = self.request('GET', 'getTransactions', params=self.page_params(params, page, page_size))
+            new_transactions, last_page = self.read_page(transactions, seen_ids, page, date_from, date_to, page_size)
+            yield from new_transactions
+            if last_page:
+                break
+            page += 1
+
+    # steps of get_transactions, shared with the async client
+    def transactions_params(self, date_from=None, date_to=None):
+        params = {}
+        if date_from is not None:
+            params[self.transactions_date_from_param] = date_from
+        if date_to is not None:
+            params[self.transactions_date_to_param] = date_to
+        return params
+
+    def page_params(self, params, page, page_size):
+        return {**params, self.transactions_page_param: page, self.transactions_page_size_param: page_size}
+
+    def read_page(self, transactions, seen_ids, page, date_from, date_to, page_size):
+        """Transactions of a page not seen on the previous pages, and whether it is the last page to request"""
+        new_transactions = [t for t in transactions if t['id'] not in seen_ids]
+        # the parameter names are not documented: if the server ignores them, the first page is
+        # the whole history, so stop there instead of downloading it again and again
+        if page == 0 and not self.respects_query(transactions, date_from, date_to, page_size):
+            return new_transactions, True
+        # stop at the last page, or if the server does not paginate and returns the same records again
+        if len(transactions) < page_size or not new_transactions:
+            return new_transactions, True
+        seen_ids.update(t['id'] for t in new_transactions)
+        return new_transactions, False
+
+    def respects_query(self, transactions, date_from, date_to, page_size):
+        """Check a first page of transactions against the page size and dates it was requested with"""
+        if len(transactions) > page_size:
+            logging.warning(f"getTransactions returned {len(transactions)} transactions for a page of {page_size}, "
+                            f"'{self.transactions_page_size_param}' seems ignored: not paginating")
+            return False
+        days = [parse_day(t['dated']) for t in transactions if t.get('dated')]
+        if (date_from is not None and any(day < parse_day(date_from) for day in days)) or \
+                (date_to is not None and any(day > parse_day(date_to) for day in days)):
+            logging.warning(f"getTransactions returned transactions outside {date_from} - {date_to}, "
+                            f"'{self.transactions_date_from_param}'/'{self.transactions_date_to_param}' "
+                            f"seem ignored: not paginating")
+            return False
+        return True
 
     def normalize_url(self, action):
         return self.url + self.url_path + 'modules/' + self.module + '/' + action
@@ -89,99 +167,127 @@ class RedRoseAPI:
 
 class RedRosePaymentsAPI:
 
-    def __init__(self, host_name=None, user_name=None, password=None):
+    def __init__(self, host_name=None, user_name=None, password=None, session=None, cassette=None):
         self.host_name = host_name
         self.basic_auth = HTTPBasicAuth(user_name, password)
+        self.session = session if session is not None else create_session(cassette=cassette)
 
-    def update_beneficiary_list_from_excel(self, comment, filename, file_path):
-        # 1. to create a new group in the system from excel file
-        response = self._post(
-            '/api/beneficiaryList/updateBeneficiaryListFromExcel',
-            params={
-                'pipeSeparatedMatcherFields': 'm.iqId',
-                'headerRowIndex': '1',
-                'ignoreDuplicateNames': 'true',
-                'comment': comment
-            },
-            payload={},
-            files=RedRosePaymentsAPI._files_excel('file', filename, file_path)
-        )
+    # paths, query parameters and response handling of the requests, shared with the async client
+    beneficiary_list_path = '/api/beneficiaryList/updateBeneficiaryListFromExcel'
+    import_status_path = '/api/bulk/getExcelImportStatus/'
+    download_distribution_path = '/api/activity/downloadIndividualDistributionExcel'
+    upload_distribution_path = '/api/activity/uploadIndividualDistributionExcel'
+    beneficiary_group_path = '/api/beneficiaryGroupList/list'
+
+    @staticmethod
+    def beneficiary_list_params(comment):
+        return {
+            'pipeSeparatedMatcherFields': 'm.iqId',
+            'headerRowIndex': '1',
+            'ignoreDuplicateNames': 'true',
+            'comment': comment
+        }
+
+    @staticmethod
+    def download_distribution_params(beneficiary_group_id, activity_id):
+        return {
+            'beneficiaryGroupId': beneficiary_group_id,
+            'activityId': activity_id
+        }
+
+    @staticmethod
+    def upload_distribution_params(activity_id):
+        return {
+            'activityId': activity_id,
+            'approveProposalsAutomatically': 'true'
+        }
+
+    @staticmethod
+    def beneficiary_group_params(beneficiary_group_name):
+        return {
+            'ignoreDeletedMarkerColumn': 'false',
+            'filter[0][column]': 'name',
+            'filter[0][value]': beneficiary_group_name
+        }
+
+    @staticmethod
+    def parse_response(response, name, default=None):
+        """JSON of a response, default if there is none (no host name) or an exception if it failed"""
         if not response:
-            return str(uuid.uuid4()).lower()
+            return default() if callable(default) else default
         elif response.status_code == 200:
             return response.json()
         else:
-            raise Exception('update_beneficiary_list_from_excel failed, status code: ' + str(response.status_code))
+            raise Exception(name + ' failed, status code: ' + str(response.status_code))
+
+    @staticmethod
+    def new_import_id():
+        # import id returned without a host name
+        return str(uuid.uuid4()).lower()
+
+    def update_beneficiary_list_from_excel(self, comment, filename, file_path=None, file_content=None):
+        # 1. to create a new group in the system from excel file
+        response = self._post(
+            self.beneficiary_list_path,
+            params=self.beneficiary_list_params(comment),
+            payload={},
+            files=RedRosePaymentsAPI._files_excel('file', filename, file_path, file_content)
+        )
+        return self.parse_response(response, 'update_beneficiary_list_from_excel', self.new_import_id)
 
     def get_excel_import_status(self, excel_import_id):
         # 2. check if template file is processed
         # 6. check uploaded distribution file is processed
         response = self._get(
-            '/api/bulk/getExcelImportStatus/' + excel_import_id,
+            self.import_status_path + excel_import_id,
             params=None
         )
-        if not response:
-            return {
-                'status': 'SUCCEEDED'
-            }
-        elif response.status_code == 200:
-            return response.json()
-        else:
-            raise Exception('get_excel_import_status failed, status code: ' + str(response.status_code))
+        return self.parse_response(response, 'get_excel_import_status', {'status': 'SUCCEEDED'})
 
     def download_individual_distribution_excel(self, beneficiary_group_id, activity_id, local_file_name):
         # 4. after creating the group, get the group id and use this to download the file to be filled in
         # activity id is fixed
         return self._download_excel_file(
-            '/api/activity/downloadIndividualDistributionExcel',
-            {
-                'beneficiaryGroupId': beneficiary_group_id,
-                'activityId': activity_id
-            },
+            self.download_distribution_path,
+            self.download_distribution_params(beneficiary_group_id, activity_id),
             'xlsx/' + local_file_name
         )
 
-    def upload_individual_distribution_excel(self, filename, file_path, activity_id):
+    def upload_individual_distribution_excel(self, filename, file_path=None, activity_id=None, file_content=None):
         # 5. after filling the individual amounts, upload it back into the system
         response = self._post(
-            '/api/activity/uploadIndividualDistributionExcel',
-            params={
-                'activityId': activity_id,
-                'approveProposalsAutomatically': 'true'
-            },
+            self.upload_distribution_path,
+            params=self.upload_distribution_params(activity_id),
             payload={},
-            files=RedRosePaymentsAPI._files_excel('distFile', filename, file_path) if self.host_name else None
+            files=RedRosePaymentsAPI._files_excel('distFile', filename, file_path, file_content)
+            if self.host_name else None
         )
-        if not response:
-            return str(uuid.uuid4()).lower()
-        elif response.status_code == 200:
-            return response.json()
-        else:
-            raise Exception('update_beneficiary_list_from_excel failed, status code: ' + str(response.status_code))
+        return self.parse_response(response, 'upload_individual_distribution_excel', self.new_import_id)
 
     def get_beneficiary_group(self, beneficiary_group_name):
         # 3. check if group is created (after processing)
         response = self._get(
-            '/api/beneficiaryGroupList/list',
-            params={
-                'ignoreDeletedMarkerColumn': 'false',
-                'filter[0][column]': 'name',
-                'filter[0][value]': beneficiary_group_name
-            }
+            self.beneficiary_group_path,
+            params=self.beneficiary_group_params(beneficiary_group_name)
         )
-        if not response:
-            return None
-        elif response.status_code == 200:
-            return response.json()
-        else:
-            raise Exception('get_beneficiary_group failed, status code: ' + str(response.status_code))
+        return self.parse_response(response, 'get_beneficiary_group')
+
+    def base_url(self):
+        # host names are served over https, unless a scheme is given (e.g. a local test server)
+        if self.host_name.startswith('http://') or self.host_name.startswith('https://'):
+            return self.host_name
+        return 'https://' + self.host_name
 
     @staticmethod
-    def _files_excel(file_param, filename, file_path):
+    def _files_excel(file_param, filename, file_path=None, file_content=None):
+        # the excel file is sent from memory (file_content, bytes) or read from disk (file_path)
+        if file_content is None:
+            with open(file_path, 'rb') as f:
+                file_content = f.read()
         return [
             (file_param, (
                filename,
-               open(file_path, 'rb'),
+               file_content,
                'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
             ))
         ]
@@ -189,8 +295,8 @@ class RedRosePaymentsAPI:
     def _download_excel_file(self, url, params, local_filename):
         if not self.host_name:
             return None
-        with requests.get(
-                'https://' + self.host_name + url, stream=True, params=params, auth=self.basic_auth
+        with self.session.get(
+                self.base_url() + url, stream=True, params=params, auth=self.basic_auth
         ) as r:
             r.raise_for_status()
             with open(local_filename, 'wb') as f:
@@ -202,14 +308,52 @@ class RedRosePaymentsAPI:
     def _get(self, url, params):
         if not self.host_name:
             return None
-        return requests.request(
-            "GET", 'https://' + self.host_name + url, params=params, auth=self.basic_auth
+        return self.session.request(
+            "GET", self.base_url() + url, params=params, auth=self.basic_auth
         )
 
     def _post(self, url, params, payload, files):
         if not self.host_name:
             return None
-        return requests.request(
-            "POST", 'https://' + self.host_name + url, params=params, data=payload, files=files,
+        return self.session.request(
+            "POST", self.base_url() + url, params=params, data=payload, files=files,
             auth=self.basic_auth
-        )
\ No newline at end of file
+        )
+
+
+class ExcelImportPoller:
+    """Wait for RedRose to process excel imports, polling the import status with exponential backoff
+    until the import succeeds or fails, the deadline passes or the poll budget is spent"""
+
+    final_statuses = ['SUCCEEDED', 'FAILED']
+
+    def __init__(self, client, initial_delay=1., max_delay=60., backoff=2., deadline=1800., max_polls=200):
+        self.client = client
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.backoff = backoff
+        self.deadline = deadline
+        self.max_polls = max_polls
+
+    def wait(self, excel_import_id):
+        """Return the final import status, or a status 'TIMEOUT' if it is not known within deadline/budget"""
+        start = time.monotonic()
+        delay = self.initial_delay
+        polls = 0
+        while True:
+            upload_result = self.client.get_excel_import_status(excel_import_id)
+            polls += 1
+            upload_result, wait = self.check(upload_result, polls, start, delay)
+            if upload_result is not None:
+                return upload_result
+            time.sleep(wait)
+            delay = min(delay * self.backoff, self.max_delay)
+
+    def check(self, upload_result, polls, start, delay):
+        """Final status of a poll (or 'TIMEOUT'), or None and the seconds to wait before the next poll"""
+        if upload_result['status'] in self.final_statuses:
+            return upload_result, None
+        remaining = self.deadline - (time.monotonic() - start)
+        if polls >= self.max_polls or remaining <= 0:
+            return {**upload_result, 'status': 'TIMEOUT', 'lastStatus': upload_result['status']}, None
+        return None, min(delay, remaining)
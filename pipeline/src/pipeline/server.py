@@ -0,0 +1,158 @@
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# maximum number of records per EspoCRM query when syncing the records of webhook calls
+WEBHOOK_BATCH_SIZE = 100
+
+
+class ChangeQueue:
+    """Ids of EspoCRM records changed since they were last taken, by entity type.
+    A record changed several times before it is taken is queued once."""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.changes = {}
+
+    def put(self, entity_type, ids):
+        with self.condition:
+            queued = self.changes.setdefault(entity_type, {})
+            for id_ in ids:
+                queued[id_] = None
+            self.condition.notify_all()
+
+    def take(self, timeout=None):
+        """Wait up to timeout seconds for changes, return and remove all queued changes (entity type -> ids)"""
+        with self.condition:
+            if not self.changes:
+                self.condition.wait(timeout)
+            changes = {entity_type: list(ids) for entity_type, ids in self.changes.items()}
+            self.changes = {}
+            return changes
+
+    def __len__(self):
+        with self.condition:
+            return sum(len(ids) for ids in self.changes.values())
+
+
+def verify_signature(signature, body, secret):
+    """Check the X-Signature header of an EspoCRM webhook call:
+    base64 of the webhook id and the HMAC-SHA256 of the body with the webhook secret, separated by ':'"""
+    try:
+        decoded = base64.b64decode(signature, validate=True)
+    except ValueError:
+        return False
+    _, separator, digest = decoded.partition(b':')
+    if not separator:
+        return False
+    expected = hmac.new(secret.encode('utf-8'), body, hashlib.sha256).digest()
+    return hmac.compare_digest(digest, expected)
+
+
+def changed_ids(entity_type, records):
+    """Ids of the records of a webhook call that can require a sync. Payments are only relevant
+    if they may be ready for payment (the call of a status update carries the new status)."""
+    if isinstance(records, dict):
+        records = [records]
+    ids = []
+    for record in records:
+        if not isinstance(record, dict) or 'id' not in record:
+            continue
+        if entity_type == 'Payment' and record.get('status', 'readyforpayment') != 'readyforpayment':
+            continue
+        ids.append(record['id'])
+    return ids
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """Receives EspoCRM webhook calls on /webhook/<entity type> and queues the changed records"""
+
+    def log_message(self, format, *args):
+        logging.debug(f"webhook {self.address_string()} {format % args}")
+
+    def reply(self, status, message):
+        body = json.dumps({'message': message}).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        # health check
+        if self.path == '/health':
+            self.reply(200, f'{len(self.server.queue)} records queued')
+        else:
+            self.reply(404, 'not found')
+
+    def do_POST(self):
+        prefix, _, entity_type = self.path.strip('/').partition('/')
+        if prefix != 'webhook' or entity_type not in self.server.entity_types:
+            self.reply(404, f'no webhook for {entity_type}')
+            return
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.server.secret is not None and \
+                not verify_signature(self.headers.get('X-Signature', ''), body, self.server.secret):
+            logging.warning(f"webhook call for {entity_type} with an invalid signature")
+            self.reply(401, 'invalid signature')
+            return
+        try:
+            records = json.loads(body)
+        except ValueError:
+            self.reply(400, 'invalid JSON')
+            return
+        ids = changed_ids(entity_type, records)
+        self.server.queue.put(entity_type, ids)
+        self.reply(202, f'{len(ids)} records queued')
+
+
+class WebhookServer(ThreadingHTTPServer):
+    """HTTP server for EspoCRM webhooks of the given entity types, optionally checking their signature"""
+
+    daemon_threads = True
+
+    def __init__(self, address, queue, entity_types, secret=None):
+        super().__init__(address, WebhookHandler)
+        self.queue = queue
+        self.entity_types = set(entity_types)
+        self.secret = secret
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        logging.info(f"listening for EspoCRM webhooks on {self.server_address[0]}:{self.server_address[1]}")
+        return self
+
+
+def ids_params(ids):
+    """EspoCRM query for the records with the given ids"""
+    return {
+        "where": [
+            {
+                "type": "in",
+                "attribute": "id",
+                "value": list(ids)
+            }
+        ]
+    }
+
+
+class Schedule:
+    """Time at which a periodic job is next due"""
+
+    def __init__(self, interval, start_now=True):
+        self.interval = interval
+        self.next_at = time.monotonic() if start_now else time.monotonic() + interval
+
+    def due(self):
+        return time.monotonic() >= self.next_at
+
+    def done(self):
+        self.next_at = time.monotonic() + self.interval
+
+    def seconds_left(self):
+        return max(self.next_at - time.monotonic(), 0.)
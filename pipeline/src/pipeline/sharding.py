@@ -0,0 +1,28 @@
+import zlib
+
+
+def parse_shard(value):
+    """Parse a shard given as 'i/n' (shard i of n, counting from 0) to (i, n)"""
+    index, separator, count = value.partition('/')
+    if not separator or not index.isdigit() or not count.isdigit() or not 0 <= int(index) < int(count):
+        raise ValueError(f"invalid shard {value}, expected i/n with 0 <= i < n")
+    return int(index), int(count)
+
+
+def sub_shards(shard, processes):
+    """Split a shard (i, n) into one shard per process, covering the same records"""
+    index, count = shard if shard is not None else (0, 1)
+    return [(index + k * count, count * processes) for k in range(processes)]
+
+
+def in_shard(id_, shard):
+    # stable across processes and runs, unlike hash()
+    index, count = shard
+    return zlib.crc32(str(id_).encode('utf-8')) % count == index
+
+
+def shard_key(name, shard):
+    """Name of a per-shard item (watermark, journal file), unchanged without shard"""
+    if shard is None:
+        return name
+    return f"{name}.shard-{shard[0]}-of-{shard[1]}"
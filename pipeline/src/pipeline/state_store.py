@@ -0,0 +1,78 @@
+import sqlite3
+import threading
+import json
+
+DEFAULT_STATE_PATH = '../data/state.db'
+
+
+class StateStore:
+    """Local persistent state of the pipeline, kept in a SQLite database"""
+
+    def __init__(self, path=DEFAULT_STATE_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        # write-ahead log: cheap commits, as hashes are written once per pushed beneficiary
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS watermarks (entity TEXT PRIMARY KEY, synced_at TEXT NOT NULL)"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS payload_hashes (iq_id TEXT PRIMARY KEY, hash TEXT NOT NULL)"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS transactions "
+                "(id TEXT PRIMARY KEY, day INTEGER NOT NULL, data TEXT NOT NULL)"
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS transactions_day ON transactions (day)"
+            )
+
+    def get_watermark(self, entity_name):
+        """Return the time of the last successful sync of an entity, or None"""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT synced_at FROM watermarks WHERE entity = ?", (entity_name,)
+            ).fetchone()
+        return row[0] if row is not None else None
+
+    def set_watermark(self, entity_name, synced_at):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO watermarks (entity, synced_at) VALUES (?, ?)", (entity_name, synced_at)
+            )
+
+    def get_payload_hash(self, iq_id):
+        """Return the hash of the last payload accepted by RedRose for a beneficiary, or None"""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT hash FROM payload_hashes WHERE iq_id = ?", (iq_id,)
+            ).fetchone()
+        return row[0] if row is not None else None
+
+    def set_payload_hash(self, iq_id, payload_hash):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO payload_hashes (iq_id, hash) VALUES (?, ?)", (iq_id, payload_hash)
+            )
+
+    def save_transactions(self, transactions, get_day):
+        """Insert or update RedRose transactions, indexed by their day number"""
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO transactions (id, day, data) VALUES (?, ?, ?)",
+                ((str(t['id']), get_day(t), json.dumps(t)) for t in transactions)
+            )
+
+    def get_transactions(self, day_from, day_to):
+        """Return the stored RedRose transactions between two day numbers (included)"""
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT data FROM transactions WHERE day BETWEEN ? AND ? ORDER BY day, id", (day_from, day_to)
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def close(self):
+        self.connection.close()
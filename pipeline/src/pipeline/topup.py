@@ -0,0 +1,288 @@
+import asyncio
+import logging
+import os
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+from datetime import datetime
+from pipeline.excel import write_workbook
+
+MAX_NUMBER_PAYMENTS = 500
+# journaled top-up requests whose status is still unknown after this many seconds or resumed runs are
+# no longer polled, and their payments are set to Failed for an operator to review
+TOPUP_JOURNAL_MAX_AGE = 2 * 24 * 3600
+TOPUP_JOURNAL_MAX_ATTEMPTS = 5
+
+
+def topup_workbook(df):
+    """Top-up excel file of a chunk of payments, as bytes"""
+    df = df.drop(columns=['id', 'rrActivity'])
+    return write_workbook(df.columns, df.itertuples(index=False))
+
+
+def split_topups(df_espo_pay, save_dir=None):
+    """Build in memory one top-up file per activity (split into chunks of MAX_NUMBER_PAYMENTS payments),
+    optionally saving a copy in save_dir. Returns a list of (activity, file name, file content, payment ids)."""
+    topups = []
+    for activity in df_espo_pay['rrActivity'].unique():
+        df_espo_pay_activity = df_espo_pay[df_espo_pay['rrActivity'] == activity]
+        # if more than MAX_NUMBER_PAYMENTS, split and create multiple topup requests
+        if len(df_espo_pay_activity) > MAX_NUMBER_PAYMENTS:
+            list_df = [df_espo_pay_activity[i:i + MAX_NUMBER_PAYMENTS]
+                       for i in range(0, len(df_espo_pay_activity), MAX_NUMBER_PAYMENTS)]
+            for ndf, df in enumerate(list_df):
+                topups.append((activity, f"IndividualTopup-{activity}-{ndf}.xlsx", topup_workbook(df),
+                               list(df['id'].unique())))
+        else:
+            topups.append((activity, f"IndividualTopup-{activity}.xlsx", topup_workbook(df_espo_pay_activity),
+                           list(df_espo_pay_activity['id'].unique())))
+    if save_dir is not None:
+        for _, topup_file, topup_content, _ in topups:
+            with open(os.path.join(save_dir, topup_file), 'wb') as f:
+                f.write(topup_content)
+    return topups
+
+
+def submit_topup(redrose_pay_client, poller, activity, topup_file, topup_content, payment_ids, journal=None):
+    """Upload a top-up file to RedRose and wait until it is processed"""
+    logging.info(f"sending {topup_file} with {len(payment_ids)} payments")
+    upload_result_id = redrose_pay_client.upload_individual_distribution_excel(
+        filename=topup_file,
+        file_content=topup_content,
+        activity_id=activity)
+    journal_upload(journal, upload_result_id, topup_file, payment_ids)
+    return wait_topup(poller, upload_result_id)
+
+
+def journal_upload(journal, upload_result_id, topup_file, payment_ids):
+    if journal is not None:
+        # from now on, these payments must not be sent again, even if the run is interrupted
+        journal.append('topup', 'upload', importId=upload_result_id, file=topup_file, payments=payment_ids,
+                       uploadedAt=time.time())
+
+
+def wait_topup(poller, upload_result_id):
+    upload_result = poller.wait(upload_result_id)
+    upload_result['importId'] = upload_result_id
+    return upload_result
+
+
+def payments_status(upload_result):
+    """Changes of the payments of a processed top-up request, or None if its status is not final"""
+    # if top-up request succeeded update corresponding payments' status
+    if upload_result['status'] == 'SUCCEEDED':
+        return {
+            "status": "Pending",
+            "dateTopup": datetime.today().strftime("%Y-%m-%d")
+        }
+    elif upload_result['status'] == 'FAILED':
+        return {"status": "Failed"}
+    return None
+
+
+def update_payments_status(espo_client, payment_ids, upload_result, journal=None):
+    data = payments_status(upload_result)
+    if data is None:
+        return
+    espo_client.mass_update('Payment', payment_ids, data)
+    if journal is not None:
+        journal.append('topup', 'writeback', importId=upload_result['importId'])
+
+
+def unfinished_topups(journal):
+    """Top-up requests uploaded by an interrupted run whose payments' status was not updated,
+    as a list of (import id, file name, payment ids)"""
+    if journal is None:
+        return []
+    written = {r['importId'] for r in journal.find('topup', 'writeback')}
+    return [(r['importId'], r['file'], r['payments']) for r in journal.find('topup', 'upload')
+            if r['importId'] not in written]
+
+
+def stale_topups(journal, max_age=TOPUP_JOURNAL_MAX_AGE, max_attempts=TOPUP_JOURNAL_MAX_ATTEMPTS):
+    """Journal records of the unfinished top-up requests uploaded more than max_age seconds ago or already resumed
+    max_attempts times, which are no longer polled"""
+    if journal is None:
+        return []
+    attempts = Counter(r['importId'] for r in journal.find('topup', 'resume'))
+    written = {r['importId'] for r in journal.find('topup', 'writeback')}
+    now = time.time()
+    stale = [r for r in journal.find('topup', 'upload') if r['importId'] not in written and
+             (attempts[r['importId']] >= max_attempts or now - r.get('uploadedAt', now) > max_age)]
+    for r in stale:
+        logging.error(f"Top-up request {r['importId']} ({r['file']}) not processed after {max_age / 3600:.0f} hours "
+                      f"or {max_attempts} resumed runs, no longer polling it: setting payments {r['payments']} "
+                      f"to Failed, check them in RedRose and set those that were not paid back to readyforpayment")
+    return stale
+
+
+def fail_stale_topups(journal, espo_client, max_age=TOPUP_JOURNAL_MAX_AGE, max_attempts=TOPUP_JOURNAL_MAX_ATTEMPTS):
+    """Set to Failed in EspoCRM the payments of the stale top-up requests, so that they are not polled on every
+    run forever. RedRose may still have processed these imports, so their payments are not sent again
+    automatically: an operator must check them in RedRose and set those that were not paid back to readyforpayment."""
+    for r in stale_topups(journal, max_age, max_attempts):
+        try:
+            espo_client.mass_update('Payment', r['payments'], {"status": "Failed"})
+        except Exception as e:
+            # still unfinished, so its payments are not sent again
+            logging.error(f"Payments of top-up request {r['importId']} not set to Failed: {e}")
+            continue
+        journal.append('topup', 'writeback', importId=r['importId'])
+
+
+def uploaded_payments(journal):
+    """Ids of the payments in the top-up requests uploaded by an interrupted run"""
+    if journal is None:
+        return set()
+    return {id_ for r in journal.find('topup', 'upload') for id_ in r['payments']}
+
+
+def prepare_topups(df_espo_pay, save_dir=None, metrics=None, journal=None):
+    """Top-up files of the payments not sent yet, as in split_topups, and the top-up requests of an interrupted run
+    to resume, as in unfinished_topups"""
+    resumed = unfinished_topups(journal)
+    uploaded = uploaded_payments(journal)
+    if uploaded and len(df_espo_pay) > 0:
+        n_payments = len(df_espo_pay)
+        df_espo_pay = df_espo_pay[~df_espo_pay['id'].isin(uploaded)]
+        if len(df_espo_pay) < n_payments:
+            logging.warning(f"{n_payments - len(df_espo_pay)} payments already sent by an interrupted run, "
+                            f"not sending them again")
+
+    with metrics.step('topup_excel') if metrics is not None else nullcontext({}) as step:
+        topups = split_topups(df_espo_pay, save_dir) if len(df_espo_pay) > 0 else []
+        step['records'] = len(df_espo_pay)
+
+    for import_id, topup_file, _ in resumed:
+        logging.info(f"resuming top-up request {import_id} ({topup_file}) of an interrupted run")
+        journal.append('topup', 'resume', importId=import_id)
+    return topups, resumed
+
+
+def check_topup(upload_result, topup_file, payment_ids, verbose=False):
+    """Log the outcome of a top-up request, return False if the status of its import is still unknown"""
+    if upload_result['status'] == 'FAILED':
+        logging.error(f"Top-up request submitted, status FAILED")
+    elif upload_result['status'] == 'TIMEOUT':
+        logging.error(f"Top-up request {upload_result['importId']} ({topup_file}) not processed in time, "
+                      f"last status {upload_result['lastStatus']}: status of payments {payment_ids} "
+                      f"not updated, check them in RedRose")
+        return False
+    elif verbose:
+        logging.info(f"Top-up request submitted, status {upload_result['status']}")
+    return True
+
+
+def create_topups(df_espo_pay, espo_client, redrose_pay_client, poller, save_dir=None, metrics=None, journal=None,
+                  max_age=TOPUP_JOURNAL_MAX_AGE, max_attempts=TOPUP_JOURNAL_MAX_ATTEMPTS, verbose=False):
+    """Create top-up requests in RedRose for the given payments and update their status in EspoCRM.
+    All top-up files are uploaded and polled concurrently (the session's limiter caps concurrent imports),
+    statuses are written back as imports complete.
+    With a journal, payments already uploaded by an interrupted run are not sent again: the status of
+    their imports is polled and written back instead, for up to max_age seconds or max_attempts runs, after which
+    their payments are set to Failed for an operator to review.
+    A failed top-up request does not stop the others.
+    Returns the files of the top-up requests whose payments' status was not updated (unknown import status
+    or error)."""
+    fail_stale_topups(journal, espo_client, max_age, max_attempts)
+    topups, resumed = prepare_topups(df_espo_pay, save_dir, metrics, journal)
+
+    unfinished = []
+    with ThreadPoolExecutor(max_workers=max(len(topups) + len(resumed), 1)) as executor:
+        futures = {
+            executor.submit(submit_topup, redrose_pay_client, poller, activity, topup_file, topup_content,
+                            payment_ids, journal): (topup_file, payment_ids)
+            for activity, topup_file, topup_content, payment_ids in topups
+        }
+        for import_id, topup_file, payment_ids in resumed:
+            futures[executor.submit(wait_topup, poller, import_id)] = (topup_file, payment_ids)
+        for future in as_completed(futures):
+            topup_file, payment_ids = futures[future]
+            try:
+                upload_result = future.result()
+            except Exception as e:
+                logging.error(f"Top-up request {topup_file} failed: {e}")
+                unfinished.append(topup_file)
+                continue
+            if not check_topup(upload_result, topup_file, payment_ids, verbose):
+                unfinished.append(topup_file)
+            try:
+                update_payments_status(espo_client, payment_ids, upload_result, journal)
+            except Exception as e:
+                logging.error(f"Status of the payments of top-up request {topup_file} not updated: {e}")
+                unfinished.append(topup_file)
+    return unfinished
+
+
+async def submit_topup_async(redrose_pay_client, poller, activity, topup_file, topup_content, payment_ids,
+                             journal=None):
+    """submit_topup for an async RedRose client and poller"""
+    logging.info(f"sending {topup_file} with {len(payment_ids)} payments")
+    upload_result_id = await redrose_pay_client.upload_individual_distribution_excel(
+        filename=topup_file,
+        file_content=topup_content,
+        activity_id=activity)
+    journal_upload(journal, upload_result_id, topup_file, payment_ids)
+    return await wait_topup_async(poller, upload_result_id)
+
+
+async def wait_topup_async(poller, upload_result_id):
+    upload_result = await poller.wait(upload_result_id)
+    upload_result['importId'] = upload_result_id
+    return upload_result
+
+
+async def update_payments_status_async(espo_client, payment_ids, upload_result, journal=None):
+    data = payments_status(upload_result)
+    if data is None:
+        return
+    await espo_client.mass_update('Payment', payment_ids, data)
+    if journal is not None:
+        journal.append('topup', 'writeback', importId=upload_result['importId'])
+
+
+async def fail_stale_topups_async(journal, espo_client, max_age=TOPUP_JOURNAL_MAX_AGE,
+                                  max_attempts=TOPUP_JOURNAL_MAX_ATTEMPTS):
+    """fail_stale_topups for an async EspoCRM client"""
+    for r in stale_topups(journal, max_age, max_attempts):
+        try:
+            await espo_client.mass_update('Payment', r['payments'], {"status": "Failed"})
+        except Exception as e:
+            # still unfinished, so its payments are not sent again
+            logging.error(f"Payments of top-up request {r['importId']} not set to Failed: {e}")
+            continue
+        journal.append('topup', 'writeback', importId=r['importId'])
+
+
+async def create_topups_async(df_espo_pay, espo_client, redrose_pay_client, poller, save_dir=None, metrics=None,
+                              journal=None, max_age=TOPUP_JOURNAL_MAX_AGE, max_attempts=TOPUP_JOURNAL_MAX_ATTEMPTS,
+                              verbose=False):
+    """create_topups with async clients: all top-up requests are uploaded, polled and written back from one
+    event loop"""
+    await fail_stale_topups_async(journal, espo_client, max_age, max_attempts)
+    topups, resumed = prepare_topups(df_espo_pay, save_dir, metrics, journal)
+    unfinished = []
+
+    async def complete(upload, topup_file, payment_ids):
+        try:
+            upload_result = await upload
+        except Exception as e:
+            logging.error(f"Top-up request {topup_file} failed: {e}")
+            unfinished.append(topup_file)
+            return
+        if not check_topup(upload_result, topup_file, payment_ids, verbose):
+            unfinished.append(topup_file)
+        try:
+            await update_payments_status_async(espo_client, payment_ids, upload_result, journal)
+        except Exception as e:
+            logging.error(f"Status of the payments of top-up request {topup_file} not updated: {e}")
+            unfinished.append(topup_file)
+
+    await asyncio.gather(
+        *(complete(submit_topup_async(redrose_pay_client, poller, activity, topup_file, topup_content, payment_ids,
+                                      journal), topup_file, payment_ids)
+          for activity, topup_file, topup_content, payment_ids in topups),
+        *(complete(wait_topup_async(poller, import_id), topup_file, payment_ids)
+          for import_id, topup_file, payment_ids in resumed))
+    return unfinished
@@ -0,0 +1,19 @@
+import math
+import re
+from datetime import date
+
+ISO_DATE = re.compile(r'\d{4}-\d{2}-\d{2}')
+
+
+def is_missing(value):
+    """True for values that EspoCRM or pandas use for missing data (None or NaN)"""
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+
+def parse_day(value):
+    """Parse a date or datetime string to a day number (proleptic Gregorian ordinal).
+    ISO dates and datetimes, as returned by EspoCRM and RedRose, are parsed without pandas."""
+    if isinstance(value, str) and ISO_DATE.match(value):
+        return date.fromisoformat(value[:10]).toordinal()
+    import pandas as pd
+    return pd.to_datetime(value).date().toordinal()